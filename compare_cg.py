@@ -1,98 +1,397 @@
+import os
 import sys
+import csv
 import json
-import colorama
-from colorama import Fore, Style
+import fnmatch
+import argparse
+from multiprocessing import Pool
 from pprint import pprint
 
+try:
+    import colorama
+    from colorama import Fore, Style
+except ImportError:
+    colorama = None
 
-def main(path1, path2, gnode=None):
-    with open(path1, 'r') as f:
-        data1 = json.load(f)
-    with open(path2, 'r') as f:
-        data2 = json.load(f)
-    deps1 = set()
-    deps2 = set()
-    for x in data1['depset']:
-        if isinstance(x, list):
-            for i in x:
-                deps1.add(i['product'])
-        else:
-            deps1.add(x['product'])
-    for x in data2['depset']:
+
+# Kind of the edges of call graphs where graph is a list of edges
+LEGACY_KIND = 'graph'
+COUNTERS = ('edges1', 'edges2', 'common', 'only1', 'only2')
+
+
+def read_depset(data):
+    deps = set()
+    for x in data.get('depset', []):
         if isinstance(x, list):
             for i in x:
-                deps2.add(i['product'])
-        else:
-            deps2.add(x['product'])
-    cg1 = {}
-    cg2 = {}
-    t1 = set()
-    t2 = set()
-    counter1 = 0
-    counter2 = 0
-    for edge in data1['graph']:
-        t1.add(tuple(edge))
-        if edge[0] in cg1.keys():
-            cg1[edge[0]].append(edge[1])
+                deps.add(i['product'])
         else:
-            cg1[edge[0]] = [edge[1]]
-    for edge in data2['graph']:
-        t2.add(tuple(edge))
-        if edge[0] in cg2.keys():
-            cg2[edge[0]].append(edge[1])
-        else:
-            cg2[edge[0]] = [edge[1]]
-    if gnode is not None:
-        pprint(cg1[gnode])
-        pprint(cg2[gnode])
-        sys.exit()
-    print(Fore.GREEN)
-    for node, edges in cg1.items():
-        if node not in cg2.keys():
-            print(node)
-            counter1 += len(edges)
-            for e in edges:
-                print("\t" + e)
-        else:
-            temp = [x for x in edges if x not in cg2[node]]
-            if len(temp) != 0:
-                print(Style.RESET_ALL + node + Fore.GREEN)
-                for e in temp:
-                    print("\t" + e)
-                    counter1 += 1
-    print(Fore.RED)
-    for node, edges in cg2.items():
-        if node not in cg1.keys():
-            print(node)
-            counter2 += len(edges)
-            for e in edges:
-                print("\t" + e)
-        else:
-            temp = [x for x in edges if x not in cg1[node]]
-            if len(temp) != 0:
-                print(Style.RESET_ALL + node + Fore.RED)
-                for e in temp:
-                    print("\t" + e)
-                    counter2 += 1
-    print(Style.RESET_ALL)
+            deps.add(x['product'])
+    return deps
+
+
+def method_uris(node, uris):
+    """Collect the URIs of the methods of a call graph, by their id.
+    """
+    if isinstance(node, dict):
+        methods = node.get('methods')
+        if isinstance(methods, dict):
+            for key, method in methods.items():
+                if isinstance(method, dict) and 'uri' in method:
+                    uris[key] = method['uri']
+        for key, value in node.items():
+            if key != 'methods':
+                method_uris(value, uris)
+    elif isinstance(node, list):
+        for value in node:
+            method_uris(value, uris)
+
+
+def read_call_graph(path):
+    """Read the edges of a call graph and its dependencies.
+
+    The ids of the nodes are replaced by the URIs of the methods, so that
+    call graphs of different builds can be compared.
+
+    Returns:
+        A dict from the kinds of calls (e.g. internalCalls) to lists of
+        (source, target), and a set of products.
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    graph = data.get('graph', [])
+    uris = {}
+    if isinstance(graph, list):
+        calls = {LEGACY_KIND: graph}
+    else:
+        calls = graph
+        method_uris(data.get('functions', {}), uris)
+    edges = {}
+    for kind, kind_edges in calls.items():
+        edges[kind] = [
+            (uris.get(str(e[0]), str(e[0])), uris.get(str(e[1]), str(e[1])))
+            for e in kind_edges
+        ]
+    return edges, read_depset(data)
+
+
+class Interner():
+    """Map the nodes to integers, and the edges to sets of integers.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def edges(self, pairs):
+        ids = self.ids
+        names = self.names
+        res = set()
+        for src, dst in pairs:
+            i = ids.get(src)
+            if i is None:
+                i = ids[src] = len(names)
+                names.append(src)
+            j = ids.get(dst)
+            if j is None:
+                j = ids[dst] = len(names)
+                names.append(dst)
+            res.add(i << 32 | j)
+        return res
+
+    def edge(self, key):
+        return self.names[key >> 32], self.names[key & 0xffffffff]
+
+
+def count(edges1, edges2):
+    common = len(edges1 & edges2)
+    return {
+        'edges1': len(edges1),
+        'edges2': len(edges2),
+        'common': common,
+        'only1': len(edges1) - common,
+        'only2': len(edges2) - common
+    }
+
+
+def nodes(edges):
+    res = set()
+    for key in edges:
+        res.add(key >> 32)
+        res.add(key & 0xffffffff)
+    return res
+
+
+def diff(path1, path2):
+    """Compare two call graphs.
+
+    Returns:
+        A dict with the counters of the edges and the nodes (summary), the
+        counters of every kind of calls (kinds), and the edges that exist
+        only in the first (only1) or the second call graph (only2), as
+        [source, target, kind].
+    """
+    edges1, deps1 = read_call_graph(path1)
+    edges2, deps2 = read_call_graph(path2)
+    interner = Interner()
+    kinds = list(edges1) + [k for k in edges2 if k not in edges1]
+    report = {'cg1': path1, 'cg2': path2, 'summary': {}, 'kinds': {},
+              'only1': [], 'only2': []}
+    all1 = set()
+    all2 = set()
+    for kind in kinds:
+        set1 = interner.edges(edges1.get(kind, []))
+        set2 = interner.edges(edges2.get(kind, []))
+        report['kinds'][kind] = count(set1, set2)
+        # Sorted by source, in the order the nodes were found
+        for side, only in (('only1', set1 - set2), ('only2', set2 - set1)):
+            report[side].extend(
+                list(interner.edge(key)) + [kind] for key in sorted(only)
+            )
+        all1 |= set1
+        all2 |= set2
+    nodes1 = nodes(all1)
+    nodes2 = nodes(all2)
+    summary = count(all1, all2)
+    summary.update({
+        'nodes1': len(nodes1),
+        'nodes2': len(nodes2),
+        'common_nodes': len(nodes1 & nodes2),
+        'deps_only1': sorted(deps1 - deps2),
+        'deps_only2': sorted(deps2 - deps1),
+    })
+    summary['identical'] = not (summary['only1'] or summary['only2'] or
+                                summary['deps_only1'] or summary['deps_only2'])
+    report['summary'] = summary
+    return report
+
+
+def write_json(report, out):
+    json.dump(report, out, indent=2)
+    out.write('\n')
+
+
+def write_csv(report, out):
+    writer = csv.writer(out)
+    writer.writerow(['side', 'kind', 'source', 'target'])
+    for side in ('only1', 'only2'):
+        for src, dst, kind in report[side]:
+            writer.writerow([side, kind, src, dst])
+
+
+def print_summary(report):
+    path1, path2 = report['cg1'], report['cg2']
+    summary = report['summary']
     print("Dependencies in {} and not in {}: {}".format(
-        path1, path2, deps1-deps2)
+        path1, path2, set(summary['deps_only1']))
     )
     print("Dependencies in {} and not in {}: {}".format(
-        path2, path1, deps2-deps1)
+        path2, path1, set(summary['deps_only2']))
+    )
+    print("Total edges {}: {}".format(path1, summary['edges1']))
+    print("Total edges {}: {}".format(path2, summary['edges2']))
+    print("Common edges: {}".format(summary['common']))
+    print("Edges in {} but not in {}: {}".format(
+        path1, path2, summary['only1'])
+    )
+    print("Edges in {} but not in {}: {}".format(
+        path2, path1, summary['only2'])
     )
-    print("Total edges {}: {}".format(path1, len(t1)))
-    print("Total edges {}: {}".format(path2, len(t2)))
-    print("Common edges: {}".format(len(t1 & t2)))
-    print("Edges in {} but not in {}: {}".format(path1, path2, counter1))
-    print("Edges in {} but not in {}: {}".format(path2, path1, counter2))
 
 
-if __name__ == "__main__":
-    gnode = None
-    if len(sys.argv) < 3:
+def print_text(report):
+    """Print the edges that exist only in one call graph, grouped by their
+    source, in green for the first and in red for the second call graph.
+    """
+    green = Fore.GREEN if colorama else ''
+    red = Fore.RED if colorama else ''
+    reset = Style.RESET_ALL if colorama else ''
+    for side, color in (('only1', green), ('only2', red)):
+        print(color)
+        previous = None
+        for src, dst, _ in report[side]:
+            if src != previous:
+                print(reset + src + color)
+                previous = src
+            print("\t" + dst)
+    print(reset)
+    print_summary(report)
+
+
+def print_node(path1, path2, node):
+    for path in (path1, path2):
+        edges, _ = read_call_graph(path)
+        pprint([dst for kind in edges.values() for src, dst in kind
+                if src == node])
+
+
+def diff_pair(pair):
+    """Compare a pair of call graphs, and write the report in a file.
+
+    Returns:
+        The name of the pair and the summary, or the error.
+    """
+    name, path1, path2, output, fmt = pair
+    try:
+        report = diff(path1, path2)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return name, {'error': str(e)}
+    if output:
+        filename = os.path.join(output, name + '.diff.' + fmt)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as out:
+            (write_csv if fmt == 'csv' else write_json)(report, out)
+    return name, report['summary']
+
+
+def find_pairs(dir1, dir2, pattern):
+    """Find the call graphs with the same relative path in two directories.
+
+    Returns:
+        A list of (name, path1, path2), where path2 is None if the call graph
+        does not exist in dir2.
+    """
+    pairs = []
+    for root, _, filenames in os.walk(dir1):
+        for filename in sorted(fnmatch.filter(filenames, pattern)):
+            path1 = os.path.join(root, filename)
+            name = os.path.relpath(path1, dir1)
+            path2 = os.path.join(dir2, name)
+            pairs.append((name, path1, path2 if os.path.isfile(path2)
+                          else None))
+    return sorted(pairs)
+
+
+def read_pairs(filename):
+    """Read pairs of call graphs from a CSV file with two columns.
+    """
+    with open(filename, 'r') as f:
+        rows = [row[:2] for row in csv.reader(f) if len(row) >= 2]
+    if not rows:
+        return []
+    prefix = os.path.commonpath(
+        [os.path.dirname(os.path.abspath(r[0])) for r in rows]
+    )
+    return [(os.path.relpath(os.path.abspath(p1), prefix), p1,
+             p2 if os.path.isfile(p2) else None) for p1, p2 in rows]
+
+
+def diff_directories(pairs, output, fmt, jobs):
+    """Compare pairs of call graphs in parallel.
+
+    Returns:
+        The summary of every pair, and the totals.
+    """
+    summaries = {}
+    tasks = []
+    for name, path1, path2 in pairs:
+        if path2 is None:
+            summaries[name] = {'error': 'missing'}
+        else:
+            tasks.append((name, path1, path2, output, fmt))
+    with Pool(jobs) as pool:
+        for name, summary in pool.imap_unordered(diff_pair, tasks):
+            summaries[name] = summary
+    totals = {key: 0 for key in COUNTERS}
+    totals.update({'pairs': len(pairs), 'identical': 0, 'different': 0,
+                   'errors': 0})
+    for summary in summaries.values():
+        if 'error' in summary:
+            totals['errors'] += 1
+            continue
+        totals['identical' if summary['identical'] else 'different'] += 1
+        for key in COUNTERS:
+            totals[key] += summary[key]
+    result = {'totals': totals,
+              'pairs': {k: summaries[k] for k in sorted(summaries)}}
+    if output:
+        os.makedirs(output, exist_ok=True)
+        with open(os.path.join(output, 'summary.json'), 'w') as out:
+            write_json(result, out)
+    return result
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Compare two call graphs, or the call graphs of two "
+                    "directories."
+    )
+    parser.add_argument('path1', nargs='?',
+                        help="Call graph, or directory with -d.")
+    parser.add_argument('path2', nargs='?',
+                        help="Call graph, or directory with -d.")
+    parser.add_argument('node', nargs='?',
+                        help="Print only the targets of this node.")
+    parser.add_argument(
+        '-f', '--format', choices=['text', 'json', 'csv'], default='text',
+        help="Format of the diff (default: text). In directory mode, "
+             "json or csv."
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help="File of the diff, or directory of the diffs and of "
+             "summary.json in directory mode (default: stdout)."
+    )
+    parser.add_argument(
+        '-d', '--directories', action='store_true',
+        help="Compare the call graphs with the same relative path in two "
+             "directories."
+    )
+    parser.add_argument(
+        '-p', '--pairs',
+        help="Compare the pairs of call graphs of a CSV file (path1,path2)."
+    )
+    parser.add_argument(
+        '--pattern', default='*.json',
+        help="Call graphs to compare in directory mode (default: *.json)."
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(),
+        help="Parallel jobs in directory mode (default: number of CPUs)."
+    )
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.pairs or args.directories:
+        if args.pairs:
+            pairs = read_pairs(args.pairs)
+        elif args.path1 and args.path2:
+            pairs = find_pairs(args.path1, args.path2, args.pattern)
+        else:
+            parser.error("You should provide 2 directories")
+        fmt = 'csv' if args.format == 'csv' else 'json'
+        result = diff_directories(pairs, args.output, fmt, args.jobs)
+        for name, summary in result['pairs'].items():
+            if 'error' in summary:
+                print("{}: error: {}".format(name, summary['error']))
+            elif not summary['identical']:
+                print("{}: {} edges only in 1, {} edges only in 2".format(
+                    name, summary['only1'], summary['only2']
+                ))
+        print(json.dumps(result['totals']))
+        totals = result['totals']
+        sys.exit(1 if totals['different'] or totals['errors'] else 0)
+    if not args.path1 or not args.path2:
         print("You should provide 2 paths")
         sys.exit()
-    if len(sys.argv) == 4:
-        gnode = sys.argv[3]
-    main(sys.argv[1], sys.argv[2], gnode)
+    if args.node is not None:
+        print_node(args.path1, args.path2, args.node)
+        sys.exit()
+    report = diff(args.path1, args.path2)
+    if args.format == 'text':
+        print_text(report)
+        return
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        (write_csv if args.format == 'csv' else write_json)(report, out)
+    finally:
+        if args.output:
+            out.close()
+    if args.format == 'csv' and args.output:
+        print_summary(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,12 +21,17 @@
 # under the License.
 #
 import os
+import math
 import time
 import json
+import struct
+import hashlib
+import sqlite3
 import argparse
 import datetime
 from kafka import KafkaProducer
 from kafka import KafkaConsumer
+from kafka import TopicPartition
 
 
 def parse_release(release):
@@ -37,73 +42,438 @@ def parse_release(release):
     return source, version, dist, arch
 
 
-def filter_sources(sources, release):
-    """Check if a source has already been consumed. If has not then add it to
-    sources dict.
+class JSONStore():
+    """Keep the consumed sources in a nested dict
+    (source -> version -> dist -> archs) saved as a JSON file.
+
+    The whole file is rewritten on every sync, hence it gets slower as the
+    history grows.
     """
-    source, version, dist, arch = parse_release(release)
-    if source not in sources.keys():
-        sources[source] = {version: {dist: [arch]}}
-        return True
-    elif version not in sources[source].keys():
-        sources[source][version] = {dist: [arch]}
-        return True
-    elif dist not in sources[source][version]:
-        sources[source][version][dist] = [arch]
+    def __init__(self, filename=None, sync_every=1):
+        self.filename = filename
+        self.sync_every = max(1, sync_every)
+        self.unsynced = 0
+        self.sources = {}
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.sources = json.load(f)
+
+    def add(self, source, version, dist, arch):
+        """Add a release, return False if it already exists.
+        """
+        sources = self.sources
+        if source not in sources.keys():
+            sources[source] = {version: {dist: [arch]}}
+        elif version not in sources[source].keys():
+            sources[source][version] = {dist: [arch]}
+        elif dist not in sources[source][version]:
+            sources[source][version][dist] = [arch]
+        elif arch not in sources[source][version][dist]:
+            sources[source][version][dist].append(arch)
+        else:
+            return False
+        self.unsynced += 1
         return True
-    elif arch not in sources[source][version][dist]:
-        sources[source][version][dist].append(arch)
+
+    def insert(self, source, version, dist, arch):
+        """Add a release known to be new.
+        """
+        self.add(source, version, dist, arch)
+
+    def releases(self):
+        for source, versions in self.sources.items():
+            for version, dists in versions.items():
+                for dist, archs in dists.items():
+                    for arch in archs:
+                        yield source, version, dist, arch
+
+    def count(self):
+        return sum(1 for _ in self.releases())
+
+    def import_json(self, filename):
+        """Merge the sources saved in another file of the JSON backend.
+        """
+        with open(filename, 'r') as f:
+            sources = json.load(f)
+        for source, versions in sources.items():
+            for version, dists in versions.items():
+                for dist, archs in dists.items():
+                    for arch in archs:
+                        self.add(source, version, dist, arch)
+        self.sync()
+
+    def should_sync(self):
+        return self.unsynced >= self.sync_every
+
+    def sync(self):
+        if self.filename and self.unsynced:
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.sources, f)
+            os.replace(self.filename + '.tmp', self.filename)
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+
+
+class SQLiteStore():
+    """Keep the consumed sources in an indexed SQLite table.
+
+    Every check is a single INSERT OR IGNORE on the primary key, the new
+    releases are committed on sync. Releases known to be new are inserted
+    in bulk.
+    """
+    def __init__(self, filename=None, sync_every=100):
+        self.sync_every = max(1, sync_every)
+        self.unsynced = 0
+        self.pending = []
+        self.db = sqlite3.connect(filename if filename else ':memory:')
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS releases ("
+            "source TEXT, version TEXT, dist TEXT, arch TEXT, "
+            "PRIMARY KEY (source, version, dist, arch)) WITHOUT ROWID"
+        )
+        self.db.commit()
+
+    def add(self, source, version, dist, arch):
+        """Add a release, return False if it already exists.
+        """
+        self._insert_pending()
+        cursor = self.db.execute(
+            "INSERT OR IGNORE INTO releases VALUES (?, ?, ?, ?)",
+            (source, version, dist, arch)
+        )
+        if cursor.rowcount == 0:
+            return False
+        self.unsynced += 1
         return True
-    return False
+
+    def insert(self, source, version, dist, arch):
+        """Add a release known to be new.
+        """
+        self.pending.append((source, version, dist, arch))
+        self.unsynced += 1
+
+    def _insert_pending(self):
+        if self.pending:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO releases VALUES (?, ?, ?, ?)",
+                self.pending
+            )
+            self.pending = []
+
+    def releases(self):
+        self._insert_pending()
+        return self.db.execute(
+            "SELECT source, version, dist, arch FROM releases"
+        )
+
+    def count(self):
+        self._insert_pending()
+        return self.db.execute("SELECT COUNT(*) FROM releases").fetchone()[0]
+
+    def import_json(self, filename):
+        """Import the sources saved by the JSON backend.
+        """
+        with open(filename, 'r') as f:
+            sources = json.load(f)
+        self.db.executemany(
+            "INSERT OR IGNORE INTO releases VALUES (?, ?, ?, ?)",
+            ((source, version, dist, arch)
+             for source, versions in sources.items()
+             for version, dists in versions.items()
+             for dist, archs in dists.items()
+             for arch in archs)
+        )
+        self.db.commit()
+
+    def should_sync(self):
+        return self.unsynced >= self.sync_every
+
+    def sync(self):
+        self._insert_pending()
+        self.db.commit()
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+
+backends = {
+    'json': JSONStore,
+    'sqlite': SQLiteStore
+}
+
+
+class BloomFilter():
+    """A Bloom filter of a fixed capacity, with the positions of a key
+    computed by double hashing of its blake2b digest.
+    """
+    def __init__(self, capacity, error_rate, count=0, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = count
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        ))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        if bits is None:
+            bits = bytearray((self.size + 7) // 8)
+        self.bits = bits
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+class ScalableBloomFilter():
+    """A Bloom filter that adds a twice as large filter with a tighter error
+    rate each time the last one is full, so that the overall error rate stays
+    below error_rate however many keys are added.
+    """
+    MAGIC = b'BLOOM1'
+    HEADER = struct.Struct('<6sQI')
+    FILTER = struct.Struct('<QdQQ')
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        self.filters = []
+
+    def add(self, key):
+        if not self.filters or \
+                self.filters[-1].count >= self.filters[-1].capacity:
+            n = len(self.filters)
+            self.filters.append(BloomFilter(
+                self.capacity * 2 ** n, self.error_rate * 0.5 ** (n + 1)
+            ))
+        self.filters[-1].add(key)
+        self.count += 1
+
+    def __contains__(self, key):
+        return any(key in f for f in self.filters)
+
+    def save(self, filename):
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(self.HEADER.pack(
+                self.MAGIC, self.count, len(self.filters)
+            ))
+            for bf in self.filters:
+                f.write(self.FILTER.pack(
+                    bf.capacity, bf.error_rate, bf.count, len(bf.bits)
+                ))
+                f.write(bf.bits)
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename, capacity=100000, error_rate=0.001):
+        """Load a snapshot, return None if it does not exist or is invalid.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                magic, count, n = cls.HEADER.unpack(
+                    f.read(cls.HEADER.size)
+                )
+                if magic != cls.MAGIC:
+                    return None
+                bloom = cls(capacity, error_rate)
+                bloom.count = count
+                for _ in range(n):
+                    c, e, k, length = cls.FILTER.unpack(
+                        f.read(cls.FILTER.size)
+                    )
+                    bits = bytearray(f.read(length))
+                    if len(bits) != length:
+                        return None
+                    bloom.filters.append(BloomFilter(c, e, k, bits))
+        except (OSError, struct.error):
+            return None
+        if bloom.filters:
+            bloom.capacity = bloom.filters[0].capacity
+            bloom.error_rate = bloom.filters[0].error_rate * 2
+        return bloom
+
+
+def release_key(source, version, dist, arch):
+    return '\0'.join((source, version, dist, arch)).encode('utf-8')
+
+
+class BloomStore():
+    """Check the releases against a Bloom filter before the store.
+
+    A release that is not in the filter is definitely new, hence it is
+    inserted without looking it up in the store. The filter is snapshotted
+    next to the store on every sync, and rebuilt from the store when the
+    snapshot does not match it.
+    """
+    def __init__(self, store, snapshot=None, capacity=100000,
+                 error_rate=0.001):
+        self.store = store
+        self.snapshot = snapshot
+        self.bloom = None
+        if snapshot:
+            self.bloom = ScalableBloomFilter.load(
+                snapshot, capacity, error_rate
+            )
+        if self.bloom is None or self.bloom.count != store.count():
+            self.bloom = ScalableBloomFilter(capacity, error_rate)
+            for release in store.releases():
+                self.bloom.add(release_key(*release))
+
+    @property
+    def unsynced(self):
+        return self.store.unsynced
+
+    def add(self, source, version, dist, arch):
+        """Add a release, return False if it already exists.
+        """
+        key = release_key(source, version, dist, arch)
+        if key not in self.bloom:
+            self.bloom.add(key)
+            self.store.insert(source, version, dist, arch)
+            return True
+        if self.store.add(source, version, dist, arch):
+            self.bloom.add(key)
+            return True
+        return False
+
+    def import_json(self, filename):
+        self.store.import_json(filename)
+        self.bloom = ScalableBloomFilter(
+            self.bloom.capacity, self.bloom.error_rate
+        )
+        for release in self.store.releases():
+            self.bloom.add(release_key(*release))
+
+    def should_sync(self):
+        return self.store.should_sync()
+
+    def sync(self):
+        self.store.sync()
+        if self.snapshot:
+            self.bloom.save(self.snapshot)
+
+    def close(self):
+        self.sync()
+        self.store.close()
+
+
+def filter_sources(store, release):
+    """Check if a source has already been consumed. If has not then add it to
+    the store.
+    """
+    return store.add(*parse_release(release))
 
 
-def run(in_topic, out_topic, servers, group, filename, sources={},
-        check_old=False):
+def replay(out_topic, servers, store, batch_size=500):
+    """Add to the store the releases already pushed to the output topic, up
+    to its current end.
+    """
+    consumer = KafkaConsumer(
+        bootstrap_servers=servers.split(','),
+        enable_auto_commit=False,
+        max_poll_records=batch_size,
+        value_deserializer=lambda x: json.loads(x.decode('utf-8'))
+    )
+    partitions = [
+        TopicPartition(out_topic, p)
+        for p in consumer.partitions_for_topic(out_topic) or []
+    ]
+    consumer.assign(partitions)
+    consumer.seek_to_beginning()
+    end_offsets = consumer.end_offsets(partitions)
+    remaining = [p for p in partitions if end_offsets[p] > 0]
+    while remaining:
+        records = consumer.poll(timeout_ms=1000, max_records=batch_size)
+        for messages in records.values():
+            for message in messages:
+                filter_sources(store, message.value)
+        remaining = [
+            p for p in remaining if consumer.position(p) < end_offsets[p]
+        ]
+    consumer.close()
+    store.sync()
+
+
+def run(in_topic, out_topic, servers, group, store, check_old=False,
+        batch_size=500, linger_ms=100, compression='gzip'):
     """Consume from a kafka topic metadata of source, filter them in order not
        to consume twice the same source, push the sources in another topic.
+
+    Messages are processed in batches of batch_size. The offsets are committed
+    only after the new sources have been pushed and saved in the store.
+    Returns when there are no more messages to consume.
     """
     # Create consumer
     consumer = KafkaConsumer(
         in_topic,
         bootstrap_servers=servers.split(','),
         auto_offset_reset='earliest',
-        enable_auto_commit=True,
+        enable_auto_commit=False,
+        max_poll_records=batch_size,
         group_id=group,
         value_deserializer=lambda x: json.loads(x.decode('utf-8'))
     )
-    # Create consumer for output topic to get all the old messages
+    # Get all the old messages of the output topic
     if check_old:
-        consumer_old = KafkaConsumer(
-            out_topic,
-            bootstrap_servers=servers.split(','),
-            auto_offset_reset='earliest',
-            value_deserializer=lambda x: json.loads(x.decode('utf-8'))
-        )
-        for message in consumer_old:
-            release = message.value
-            filter_sources(sources, release)
+        replay(out_topic, servers, store, batch_size)
     # Create producer
     producer = KafkaProducer(
         bootstrap_servers=servers.split(','),
         api_version=(2, 5, 0),
+        linger_ms=linger_ms,
+        batch_size=256 * 1024,
+        compression_type=compression,
         value_serializer=lambda x: x.encode('utf-8')
     )
 
     # Read messages
-    for message in consumer:
-        release = message.value
-        print("{}: Consuming {}".format(
-            str(datetime.datetime.now()), release)
-        )
-        # Check if source is in sources
-        if filter_sources(sources, release):
-            # Push release to topic
-            producer.send(out_topic, json.dumps(release))
-            # Save sources
-            if filename:
-                with open(filename, 'w') as f:
-                    json.dump(sources, f)
-    return sources
+    uncommitted = False
+    while True:
+        records = consumer.poll(timeout_ms=5000, max_records=batch_size)
+        consumed = 0
+        pushed = 0
+        for messages in records.values():
+            for message in messages:
+                release = message.value
+                consumed += 1
+                # Check if source is in sources
+                if filter_sources(store, release):
+                    # Push release to topic
+                    producer.send(out_topic, json.dumps(release))
+                    pushed += 1
+        if consumed:
+            uncommitted = True
+            print("{}: Consumed {} releases, pushed {}".format(
+                str(datetime.datetime.now()), consumed, pushed)
+            )
+        # Commit when there is nothing to save, when the store must be saved,
+        # or when the topic is drained
+        if uncommitted and \
+                (not consumed or store.unsynced == 0 or store.should_sync()):
+            producer.flush()
+            store.sync()
+            consumer.commit()
+            uncommitted = False
+        if not consumed:
+            break
+    producer.close()
+    consumer.close()
 
 
 def get_parser():
@@ -144,6 +514,60 @@ def get_parser():
         action='store_true',
         help="Read messages from output topic before start",
     )
+    parser.add_argument(
+        '-B',
+        '--backend',
+        choices=list(backends.keys()),
+        default='json',
+        help="Store of the sources metadata."
+    )
+    parser.add_argument(
+        '--sync-every',
+        type=int,
+        default=100,
+        help="Number of new sources after which the store is saved."
+    )
+    parser.add_argument(
+        '--import-json',
+        help="Import the sources saved in a JSON file by the json backend."
+    )
+    parser.add_argument(
+        '--no-bloom',
+        dest='bloom',
+        action='store_false',
+        help="Do not check the sources against a Bloom filter."
+    )
+    parser.add_argument(
+        '--bloom-capacity',
+        type=int,
+        default=100000,
+        help="Initial capacity of the Bloom filter."
+    )
+    parser.add_argument(
+        '--bloom-error-rate',
+        type=float,
+        default=0.001,
+        help="False positive rate of the Bloom filter."
+    )
+    parser.add_argument(
+        '-n',
+        '--batch-size',
+        type=int,
+        default=500,
+        help="Number of messages to consume at once."
+    )
+    parser.add_argument(
+        '--linger-ms',
+        type=int,
+        default=100,
+        help="Time to wait for more messages before sending a batch."
+    )
+    parser.add_argument(
+        '--compression',
+        choices=['gzip', 'snappy', 'lz4', 'zstd', 'none'],
+        default='none',
+        help="Compression of the pushed messages."
+    )
     return parser
 
 
@@ -159,21 +583,28 @@ def main():
     filename = args.filename if args.filename else False
     check_old = args.check_old
 
-    # Read the sources that has been already consumed
-    sources = {}
-    if filename:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                sources = json.load(f)
+    # Open the store of the sources that has been already consumed
+    store = backends[args.backend](filename, args.sync_every)
+    if args.bloom:
+        store = BloomStore(
+            store, filename + '.bloom' if filename else None,
+            args.bloom_capacity, args.bloom_error_rate
+        )
+    if args.import_json:
+        store.import_json(args.import_json)
 
     # Run forever
-    while True:
-        sources = run(
-            in_topic, out_topic, bootstrap_servers, group,
-            filename, sources, check_old
-        )
-        check_old = False
-        time.sleep(sleep_time)
+    try:
+        while True:
+            run(
+                in_topic, out_topic, bootstrap_servers, group,
+                store, check_old, args.batch_size, args.linger_ms,
+                None if args.compression == 'none' else args.compression
+            )
+            check_old = False
+            time.sleep(sleep_time)
+    finally:
+        store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,542 @@
+# Copyright (c) 2018-2020 FASTEN.
+#
+# This file is part of FASTEN
+# (see https://www.fasten-project.eu/).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Compact binary format for FASTEN call graphs.
+
+A file starts with a fixed header (magic, version, compression, size of the
+body), followed by the body, optionally compressed with zstd. The body
+contains, aligned to 8 bytes:
+
+* a string table: the number of strings, their offsets (u64) and the UTF-8
+  blob, with every node id and method URI stored once,
+* the edges: for every kind of calls (internalCalls, externalCalls, ...)
+  three int32 arrays, sources, targets, and metadata, the first two indexes
+  to the string table and the last an index to a list of distinct metadata,
+* a skeleton: the rest of the call graph as JSON, where the URIs of the
+  methods are replaced by their index to the string table.
+
+An uncompressed file can be memory-mapped, and its edges are then read
+without copying them.
+"""
+import os
+import sys
+import copy
+import json
+import mmap
+import struct
+import argparse
+from array import array
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'FCG\x00'
+VERSION = 1
+NONE = 0
+ZSTD = 1
+HEADER = struct.Struct('<4sBBxxQ')
+# Offsets of the string table, of the edges, and of the skeleton
+SECTIONS = struct.Struct('<QQQQ')
+# Count, and flags of a kind of calls
+KIND = struct.Struct('<QII')
+# The edges have metadata (a third element)
+HAS_METADATA = 1
+
+
+class FormatError(Exception):
+    pass
+
+
+def _pad(buf):
+    buf.extend(b'\0' * (-len(buf) % 8))
+
+
+def _methods(node):
+    """Yield the methods of the functions of a call graph, in the values of
+    every "methods" object.
+    """
+    if isinstance(node, dict):
+        methods = node.get('methods')
+        if isinstance(methods, dict):
+            for method in methods.values():
+                if isinstance(method, dict):
+                    yield method
+        for key, value in node.items():
+            if key != 'methods':
+                yield from _methods(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _methods(value)
+
+
+class _Builder():
+    """The string table, the edges, and the metadata of a compact call graph
+    being serialized.
+    """
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+        self.metadata = []
+        self.metadata_index = {}
+        self.kinds = []
+        self.edges = bytearray()
+
+    def intern(self, s):
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def _intern_metadata(self, value):
+        key = json.dumps(value, sort_keys=True)
+        i = self.metadata_index.get(key)
+        if i is None:
+            i = self.metadata_index[key] = len(self.metadata)
+            self.metadata.append(value)
+        return i
+
+    def add_calls(self, kind, calls):
+        """Add a kind of calls, consisting of [str, str] or [str, str,
+        metadata] edges of the same length.
+
+        Args:
+            calls: an iterable of edges, consumed once
+
+        Returns:
+            None if the calls have been added, or the list of calls, to be
+            kept in the skeleton, if they cannot be compacted.
+        """
+        strings, metadata = len(self.strings), len(self.metadata)
+        src = array('i')
+        dst = array('i')
+        meta = array('i')
+        length = None
+        rest = None
+        for edge in calls:
+            if rest is not None:
+                rest.append(edge)
+                continue
+            if length is None and isinstance(edge, list):
+                length = len(edge)
+            if length in (2, 3) and isinstance(edge, list) and \
+                    len(edge) == length and isinstance(edge[0], str) and \
+                    isinstance(edge[1], str):
+                src.append(self.intern(edge[0]))
+                dst.append(self.intern(edge[1]))
+                if length == 3:
+                    meta.append(self._intern_metadata(edge[2]))
+                continue
+            # Not compactable, restore the calls read so far and forget
+            # their strings
+            rest = [
+                [self.strings[x], self.strings[y]] +
+                ([self.metadata[m]] if length == 3 else [])
+                for x, y, m in zip(src, dst, meta if length == 3 else src)
+            ]
+            rest.append(edge)
+            for x in self.strings[strings:]:
+                del self.index[x]
+            del self.strings[strings:]
+            for x in self.metadata[metadata:]:
+                del self.metadata_index[json.dumps(x, sort_keys=True)]
+            del self.metadata[metadata:]
+        if rest is not None:
+            return rest
+        if not src:
+            return []
+        self.kinds.append(kind)
+        self.edges.extend(KIND.pack(
+            len(src), HAS_METADATA if length == 3 else 0, 0
+        ))
+        for a in (src, dst, meta):
+            if sys.byteorder != 'little':
+                a.byteswap()
+            self.edges.extend(a.tobytes())
+            _pad(self.edges)
+        return None
+
+    def dumps(self, skeleton, compress=True):
+        """Serialize the call graph, with the rest of the document in
+        skeleton, whose URIs of the methods are replaced by their index.
+        """
+        for method in _methods(skeleton.get('functions')):
+            if isinstance(method.get('uri'), str):
+                method['uri'] = self.intern(method['uri'])
+
+        body = bytearray(SECTIONS.size)
+        strings_offset = len(body)
+        encoded = [s.encode('utf-8') for s in self.strings]
+        offsets = array('Q', [0])
+        for s in encoded:
+            offsets.append(offsets[-1] + len(s))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        body.extend(struct.pack('<Q', len(self.strings)))
+        body.extend(offsets.tobytes())
+        for s in encoded:
+            body.extend(s)
+        _pad(body)
+        edges_offset = len(body)
+        body.extend(struct.pack('<Q', len(self.kinds)))
+        body.extend(self.edges)
+        skeleton_offset = len(body)
+        body.extend(json.dumps({
+            'kinds': self.kinds,
+            'metadata': self.metadata,
+            'document': skeleton
+        }).encode('utf-8'))
+        SECTIONS.pack_into(
+            body, 0, strings_offset, edges_offset, skeleton_offset, len(body)
+        )
+
+        compression = NONE
+        if compress and zstandard is not None:
+            compression = ZSTD
+            body = zstandard.ZstdCompressor().compress(bytes(body))
+        return HEADER.pack(MAGIC, VERSION, compression, len(body)) + \
+            bytes(body)
+
+
+def dumps(document, compress=True):
+    """Serialize a FASTEN call graph to the compact format.
+
+    Args:
+        document: the call graph (dict)
+        compress: compress the body with zstd, if zstandard is available
+
+    Returns:
+        bytes
+    """
+    builder = _Builder()
+    skeleton = dict(document)
+    graph = document.get('graph')
+    # A list of calls, or a dict of kinds of calls
+    if isinstance(graph, list):
+        if builder.add_calls('', graph) is None:
+            skeleton['graph'] = None
+    elif isinstance(graph, dict):
+        skeleton['graph'] = {
+            k: v if not isinstance(v, list) or
+            builder.add_calls(k, v) is not None else None
+            for k, v in graph.items()
+        }
+    # Replace the URIs of the methods by their index, in a copy
+    if 'functions' in document:
+        skeleton['functions'] = json.loads(json.dumps(document['functions']))
+    return builder.dumps(skeleton, compress)
+
+
+class _JSONStream():
+    """Read a JSON text value by value, so that the calls of a call graph
+    are read one at a time instead of loading the whole file.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size):
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+            return
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        """Return the next character that is not a whitespace, or '' at the
+        end of the file.
+        """
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill(self.chunk_size)
+
+    def take(self, char):
+        if self.peek() != char:
+            raise FormatError("Expected {!r} at {!r}".format(
+                char, self.buf[self.pos:self.pos + 20]
+            ))
+        self.pos += 1
+
+    def value(self):
+        """Read the next value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number may go on in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Read as much again, so that long values are parsed a few times
+            self._fill(max(self.chunk_size, len(self.buf) - self.pos))
+
+    def keys(self):
+        """Yield the keys of the next object, the value of every key must be
+        read before the next one.
+        """
+        self.take('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.take(':')
+            yield key
+            if self.peek() == '}':
+                self.pos += 1
+                return
+            self.take(',')
+
+    def values(self):
+        """Yield the values of the next array.
+        """
+        self.take('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            self.take(',')
+
+
+class CompactCallGraph():
+    """Read a call graph in the compact format.
+
+    Uncompressed files are memory-mapped.
+    """
+    def __init__(self, filename):
+        self.mmap = None
+        with open(filename, 'rb') as f:
+            magic, version, compression, length = HEADER.unpack(
+                f.read(HEADER.size)
+            )
+            if magic != MAGIC or version != VERSION:
+                raise FormatError("Not a compact call graph: " + filename)
+            if compression == ZSTD:
+                if zstandard is None:
+                    raise FormatError(
+                        "zstandard is required to read " + filename
+                    )
+                body = zstandard.ZstdDecompressor().decompress(f.read(length))
+            elif compression == NONE:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                body = memoryview(self.mmap)[HEADER.size:HEADER.size + length]
+            else:
+                raise FormatError("Unknown compression: {}".format(compression))
+        self.body = memoryview(body)
+        strings_offset, edges_offset, skeleton_offset, end = \
+            SECTIONS.unpack_from(self.body, 0)
+        count = struct.unpack_from('<Q', self.body, strings_offset)[0]
+        start = strings_offset + 8
+        self.offsets = self._array('Q', start, count + 1)
+        self.blob = start + (count + 1) * 8
+        self.count = count
+        skeleton = json.loads(bytes(self.body[skeleton_offset:end]))
+        self.kinds = skeleton['kinds']
+        self.metadata = skeleton['metadata']
+        self.skeleton = skeleton['document']
+        self.calls = {}
+        offset = edges_offset + 8
+        for kind in self.kinds:
+            n, flags, _ = KIND.unpack_from(self.body, offset)
+            offset += KIND.size
+            arrays = []
+            # The metadata array is empty if the edges have no metadata
+            for size in (n, n, n if flags & HAS_METADATA else 0):
+                arrays.append(self._array('i', offset, size))
+                offset += size * 4 + (-(size * 4) % 8)
+            if not flags & HAS_METADATA:
+                arrays[2] = None
+            self.calls[kind] = arrays
+
+    def _array(self, typecode, offset, n):
+        size = array(typecode).itemsize
+        view = self.body[offset:offset + n * size]
+        if sys.byteorder == 'little':
+            return view.cast(typecode)
+        a = array(typecode, bytes(view))
+        a.byteswap()
+        return a
+
+    def string(self, i):
+        start = self.blob + self.offsets[i]
+        end = self.blob + self.offsets[i + 1]
+        return bytes(self.body[start:end]).decode('utf-8')
+
+    def strings(self):
+        blob = bytes(self.body[self.blob:self.blob + self.offsets[self.count]])
+        offsets = self.offsets
+        return [blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+                for i in range(self.count)]
+
+    def edges(self, kind=''):
+        """Return the sources and the targets of a kind of calls, as indexes
+        to the string table.
+        """
+        src, dst, _ = self.calls[kind]
+        return src, dst
+
+    def to_fasten(self):
+        """Return the call graph in the FASTEN JSON format.
+        """
+        strings = self.strings()
+        document = dict(self.skeleton)
+        calls = {}
+        for kind in self.kinds:
+            src, dst, meta = self.calls[kind]
+            if meta is None:
+                calls[kind] = [[strings[s], strings[d]]
+                               for s, d in zip(src, dst)]
+            else:
+                metadata = self.metadata
+                calls[kind] = [
+                    [strings[s], strings[d], copy.deepcopy(metadata[m])]
+                    for s, d, m in zip(src, dst, meta)
+                ]
+        if calls:
+            if '' in calls:
+                document['graph'] = calls['']
+            else:
+                document['graph'] = {
+                    k: calls[k] if k in calls else v
+                    for k, v in document['graph'].items()
+                }
+        if 'functions' in document:
+            document['functions'] = copy.deepcopy(document['functions'])
+        for method in _methods(document.get('functions')):
+            if isinstance(method.get('uri'), int):
+                method['uri'] = strings[method['uri']]
+        return document
+
+    def close(self):
+        # Release the views of the file before closing it
+        views = [self.offsets] + [a for arrays in self.calls.values()
+                                  for a in arrays]
+        for view in views:
+            if isinstance(view, memoryview):
+                view.release()
+        self.body.release()
+        if self.mmap is not None:
+            self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write(document, filename, compress=True):
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(dumps(document, compress))
+    os.replace(filename + '.tmp', filename)
+
+
+def convert(source, filename, compress=True):
+    """Convert a call graph file in the FASTEN JSON format to the compact
+    format. Unlike write, only one call at a time is parsed, so the memory
+    usage stays close to the size of the compact call graph.
+    """
+    builder = _Builder()
+    skeleton = {}
+    with open(source, 'r') as f:
+        stream = _JSONStream(f)
+        for key in stream.keys():
+            if key == 'graph' and stream.peek() == '[':
+                skeleton[key] = builder.add_calls('', stream.values())
+            elif key == 'graph' and stream.peek() == '{':
+                graph = skeleton[key] = {}
+                for kind in stream.keys():
+                    if stream.peek() == '[':
+                        graph[kind] = builder.add_calls(kind, stream.values())
+                    else:
+                        graph[kind] = stream.value()
+            else:
+                skeleton[key] = stream.value()
+        if stream.peek() != '':
+            raise FormatError("Extra data after the call graph: " + source)
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(builder.dumps(skeleton, compress))
+    os.replace(filename + '.tmp', filename)
+
+
+def read(filename):
+    """Read a compact call graph in the FASTEN JSON format.
+    """
+    with CompactCallGraph(filename) as cg:
+        return cg.to_fasten()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        "Convert call graphs between the FASTEN JSON and the compact format."
+    )
+    parser.add_argument('input', help="Call graph to convert.")
+    parser.add_argument('output', help="Converted call graph.")
+    parser.add_argument(
+        '-d',
+        '--decompress',
+        action='store_true',
+        help="Convert a compact call graph to JSON."
+    )
+    parser.add_argument(
+        '--no-zstd',
+        dest='compress',
+        action='store_false',
+        help="Do not compress the compact call graph, so that it can be "
+             "memory-mapped."
+    )
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.decompress:
+        with open(args.output, 'w') as f:
+            json.dump(read(args.input), f)
+    else:
+        convert(args.input, args.output, args.compress)
+
+
+if __name__ == "__main__":
+    main()
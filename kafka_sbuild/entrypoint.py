@@ -22,23 +22,39 @@
 #
 import os
 import sys
+import errno
 import glob
 import time
+import fnmatch
 import datetime
 import json
 import argparse
 import shutil
 import urllib
+import hashlib
+import lzma
+import sqlite3
 import requests
 import ast
 import pycurl
+import threading
+import collections
 import subprocess as sp
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from distutils.dir_util import copy_tree
 from fasten.plugins.kafka import KafkaPlugin
 from fasten.plugins.base import PluginError
+import compact_cg
+import metrics
+from kafka import KafkaConsumer, KafkaProducer, OffsetAndMetadata
+from kafka import ConsumerRebalanceListener
+from kafka.errors import CommitFailedError
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.connectionpool import (
+    HTTPConnectionPool, HTTPSConnectionPool
+)
 from requests.exceptions import RequestException
 from contextlib import closing
 from bs4 import BeautifulSoup
@@ -46,9 +62,19 @@ from bs4 import BeautifulSoup
 
 archive_mirror = 'https://snapshot.debian.org'
 snap_url = archive_mirror + '/package/{}/{}/'
-deb_url = 'http://deb.debian.org/debian/pool/main/{}/{}/{}'
+deb_mirror = 'http://deb.debian.org/debian'
+deb_url = deb_mirror + '/pool/main/{}/{}/{}'
 download_url = archive_mirror + '{}'
-last_request = None
+# .deb files of the apt cache used in the last hour are never pruned
+APT_CACHE_MIN_AGE = 60 * 60
+# Age after which the apt archives of a session are stale
+APT_SESSION_MAX_AGE = 24 * 60 * 60
+# Components of the archive indexed by SourcesIndex
+SOURCES_COMPONENTS = ('main', 'contrib', 'non-free')
+# Size, relative to its limit, to which the sources cache is pruned
+CACHE_LOW_WATERMARK = 0.9
+# Disk space reserved for a prefetch before the size of a download is known
+PREFETCH_EXPECTED_SIZE = 64 * 1024 * 1024
 
 
 deb_lookup = [
@@ -64,6 +90,252 @@ deb_lookup_l = [
     'liby', 'libz'
 ]
 
+class TokenBucket():
+    """A thread safe token bucket to rate limit requests.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and consume it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.timestamp) * self.rate
+                )
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                sleep_time = (1 - self.tokens) / self.rate
+            time.sleep(sleep_time)
+
+
+# Settings of the fetch stage, they can be changed with configure_fetching()
+fetch_jobs = 4
+host_connections = 2
+pool_size = 10
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+stats_lock = threading.Lock()
+# snapshot.d.o does not like more than one request every 1.5 seconds
+# s/r  r/h
+# 3    1020
+# 2.5  1384
+# 2.4  1408
+# 2    1466
+# 1.5  2267
+snapshot_limiter = TokenBucket(1 / 1.5)
+# Process-wide connection pools. All the requests share the same
+# requests.Session, and every thread reuses its own pycurl.Curl handle. The
+# curl handles share their connection, DNS and TLS session caches.
+http_session = None
+http_session_lock = threading.Lock()
+curl_handles = threading.local()
+curl_share = None
+# Counters of the requests of the package downloaded by the current thread
+connection_counts = threading.local()
+
+
+def configure_fetching(jobs, connections, pool=10):
+    """Set the number of parallel downloads, the connections per host, and
+    the size of the connection pools.
+    """
+    global fetch_jobs, host_connections, pool_size, http_session
+    fetch_jobs = max(1, jobs)
+    host_connections = max(1, connections)
+    pool_size = max(1, pool)
+    with host_semaphores_lock:
+        host_semaphores.clear()
+    with http_session_lock:
+        if http_session is not None:
+            http_session.close()
+        http_session = None
+
+
+def configure_mirrors(snapshot_mirror=None, debian_mirror=None):
+    """Use different mirrors than snapshot.debian.org and deb.debian.org,
+    for example a local mirror or a local HTTP server for testing.
+    """
+    global archive_mirror, snap_url, download_url, deb_mirror, deb_url
+    if snapshot_mirror:
+        archive_mirror = snapshot_mirror.rstrip('/')
+        snap_url = archive_mirror + '/package/{}/{}/'
+        download_url = archive_mirror + '{}'
+    if debian_mirror:
+        deb_mirror = debian_mirror.rstrip('/')
+        deb_url = deb_mirror + '/pool/main/{}/{}/{}'
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """A connection pool that counts the requests and the new connections
+    of the current thread.
+    """
+    def _new_conn(self):
+        count_connections(0, 1)
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        count_connections(1, 0)
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        count_connections(0, 1)
+        return super()._new_conn()
+
+    def urlopen(self, *args, **kwargs):
+        count_connections(1, 0)
+        return super().urlopen(*args, **kwargs)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+
+def get_session():
+    """Return the shared requests.Session.
+    """
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            session = requests.Session()
+            retry = Retry(connect=5, backoff_factor=0.5)
+            adapter = CountingHTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size,
+                max_retries=retry
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            http_session = session
+        return http_session
+
+
+def get_curl():
+    """Return the pycurl.Curl handle of the current thread, reset to its
+    default options. Resetting a handle keeps its open connections alive.
+    """
+    global curl_share
+    with http_session_lock:
+        if curl_share is None:
+            curl_share = pycurl.CurlShare()
+            for data in ('LOCK_DATA_CONNECT', 'LOCK_DATA_DNS',
+                         'LOCK_DATA_SSL_SESSION'):
+                if hasattr(pycurl, data):
+                    try:
+                        curl_share.setopt(
+                            pycurl.SH_SHARE, getattr(pycurl, data)
+                        )
+                    except pycurl.error:
+                        pass
+    c = getattr(curl_handles, 'curl', None)
+    if c is None:
+        c = pycurl.Curl()
+        c.setopt(pycurl.SHARE, curl_share)
+        curl_handles.curl = c
+    # pycurl keeps the share object on reset
+    c.reset()
+    c.setopt(pycurl.MAXCONNECTS, pool_size)
+    # Use HTTP/2 when the server supports it
+    if hasattr(pycurl, 'CURL_HTTP_VERSION_2TLS'):
+        try:
+            c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+        except pycurl.error:
+            pass
+    return c
+
+
+def track_connections(counts):
+    """Count the requests of the current thread, and the connections they
+    open, in counts (a dict shared by the threads of a download), or stop
+    counting them if counts is None.
+    """
+    connection_counts.counts = counts
+
+
+def count_connections(requests_made, new_connections):
+    counts = getattr(connection_counts, 'counts', None)
+    if counts is None:
+        return
+    with stats_lock:
+        counts['requests'] += requests_made
+        counts['new_connections'] += new_connections
+
+
+def connection_metrics(counts):
+    """Return the number of requests, and how many of them opened a new
+    connection or reused one from the pools.
+    """
+    with stats_lock:
+        result = dict(counts)
+    result['reused_connections'] = max(
+        0, result['requests'] - result['new_connections']
+    )
+    return result
+
+
+def host_semaphore(url):
+    """Return the semaphore that limits the connections to the host of url.
+    """
+    host = urllib.parse.urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(
+                host_connections
+            )
+        return host_semaphores[host]
+
+
+# Metrics of the plugin
+registry = metrics.Registry()
+phase_seconds = registry.histogram(
+    'fasten_phase_seconds', 'Duration of the phases of a package.', ['phase']
+)
+step_max_rss = registry.histogram(
+    'fasten_step_max_rss_bytes',
+    'Maximum resident set size of the build and analysis steps.', ['step'],
+    buckets=metrics.MEMORY_BUCKETS
+)
+step_cpu = registry.counter(
+    'fasten_step_cpu_seconds_total',
+    'CPU time of the build and analysis steps.', ['step', 'mode']
+)
+packages_total = registry.counter(
+    'fasten_packages_total', 'Packages processed.', ['status']
+)
+cache_total = registry.counter(
+    'fasten_source_cache_total', 'Lookups in the sources cache.', ['result']
+)
+http_requests_total = registry.counter(
+    'fasten_http_requests_total', 'HTTP requests of the downloads.',
+    ['connection']
+)
+produced_messages_total = registry.counter(
+    'fasten_produced_messages_total', 'Messages produced.', ['topic']
+)
+produced_bytes_total = registry.counter(
+    'fasten_produced_bytes_total',
+    'Bytes produced, before compression.', ['topic']
+)
+consumer_lag = registry.gauge(
+    'fasten_consumer_lag', 'Records of the partition not consumed yet.',
+    ['topic', 'partition']
+)
+
+
 class IntermediatePluginError(Exception):
     """Error that occurs on non fatal cases
     """
@@ -75,6 +347,249 @@ def create_dir(dir_name):
     return dir_name
 
 
+class SourceCache():
+    """A persistent content-addressed cache of downloaded source files.
+
+    Files are stored under their checksum (as found in the .dsc) or, when no
+    checksum is known, under a hash of their name and size. Entries are
+    hardlinked in and out of the cache, and verified against their checksum
+    when they are used. The least recently used ones are evicted when the
+    cache grows bigger than max_size bytes, down to CACHE_LOW_WATERMARK of
+    it.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = create_dir(directory)
+        self.max_size = max_size
+        # Running total of the size of the cache, None until it is measured
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.split('-')[-1][:2], key)
+
+    def fetch(self, key, filename, checksum=None):
+        """Copy a cached file to filename. Returns False on a cache miss.
+
+        An entry that does not match checksum (algorithm, digest, size) is
+        removed and reported as a miss.
+        """
+        path = self._path(key)
+        try:
+            link_or_copy(path, filename)
+        except OSError:
+            return False
+        if checksum is not None and checksum[1] and \
+                not file_matches(filename, checksum):
+            for corrupted in (filename, path):
+                try:
+                    os.remove(corrupted)
+                except OSError:
+                    pass
+            return False
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def store(self, key, filename):
+        """Add filename to the cache and evict old entries if needed.
+        """
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        create_dir(os.path.dirname(path))
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            link_or_copy(filename, tmp)
+            os.replace(tmp, path)
+            size = os.path.getsize(path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = directory_size(self.directory)
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        CACHE_LOW_WATERMARK of max_size. The size of the cache is measured
+        again on the next store, as other plugins may share the cache.
+        """
+        evict_lru(self.directory, int(self.max_size * CACHE_LOW_WATERMARK))
+        self.size = None
+
+
+def evict_lru(directory, max_size, pattern='*', min_age=0, recursive=True):
+    """Remove the least recently used files of a directory (recursively)
+    until their total size is at most max_size bytes.
+
+    Args:
+        directory: the directory to prune
+        max_size: maximum size in bytes
+        pattern: glob pattern of the files that can be removed
+        min_age: keep the files used in the last min_age seconds
+        recursive: prune the subdirectories too
+
+    Returns:
+        The number of bytes removed.
+    """
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        if not recursive:
+            dirs[:] = []
+        for f in files:
+            if not fnmatch.fnmatch(f, pattern):
+                continue
+            path = os.path.join(root, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            # Reading a file may update its access time only
+            entries.append((max(st.st_mtime, st.st_atime), st.st_size, path))
+            total += st.st_size
+    entries.sort()
+    removed = 0
+    now = time.time()
+    for used, size, path in entries:
+        if total <= max_size or now - used < min_age:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += size
+        except OSError:
+            pass
+    return removed
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst, fallback to copy if they are on different file
+    systems.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        if not os.path.isfile(src):
+            raise
+        shutil.copyfile(src, dst)
+
+
+def cache_key(url, checksum=None):
+    """Return the cache key of a file.
+
+    Files without a known checksum (usually the .dsc) are keyed by their
+    name, which is unique in the archive, so the same file downloaded from
+    snapshot.debian.org and from the mirror is cached once.
+
+    Args:
+        url
+        checksum: None or a tuple (algorithm, digest, size) from the .dsc
+    """
+    if checksum is not None and checksum[1]:
+        return '{}-{}'.format(checksum[0], checksum[1])
+    name = urllib.parse.unquote(url[url.rfind('/')+1:])
+    size = checksum[2] if checksum is not None else ''
+    digest = hashlib.sha256('{}\n{}'.format(name, size).encode()).hexdigest()
+    return 'name-{}'.format(digest)
+
+
+def file_matches(filename, checksum):
+    """Check the size and the digest of a file.
+
+    Args:
+        checksum: a tuple (algorithm, digest, size)
+    """
+    try:
+        if str(os.path.getsize(filename)) != str(checksum[2]):
+            return False
+        digest = hashlib.new(checksum[0])
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(StreamWriter.chunk_size), b''):
+                digest.update(chunk)
+    except (OSError, ValueError):
+        return False
+    return digest.hexdigest() == checksum[1]
+
+
+def parse_dsc_checksums(filename):
+    """Parse the checksums of the files listed in a .dsc file.
+
+    Returns:
+        dict: filename -> (algorithm, digest, size). Checksums-Sha256 is
+        preferred, the md5sums of the Files field are used otherwise.
+    """
+    fields = {'Checksums-Sha256': 'sha256', 'Files': 'md5'}
+    checksums = {'sha256': {}, 'md5': {}}
+    current = None
+    try:
+        with open(filename, 'r', errors='replace') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith((' ', '\t')) and current is not None:
+                    parts = line.split()
+                    if len(parts) == 3:
+                        checksums[current][parts[2]] = (
+                            current, parts[0], parts[1]
+                        )
+                    continue
+                current = fields.get(line.split(':')[0])
+    except OSError:
+        return {}
+    result = checksums['md5']
+    result.update(checksums['sha256'])
+    return result
+
+
+class StreamWriter():
+    """Write a download to a file object in chunks and compute its checksum
+    on the fly.
+
+    If the file already contains a partial download, its content is hashed
+    first so that the download can resume from its end.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, f, algorithm=None):
+        self.f = f
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm) if algorithm else None
+        if self.hash is not None:
+            f.seek(0)
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                self.hash.update(chunk)
+        f.seek(0, os.SEEK_END)
+
+    def write(self, data):
+        if self.hash is not None:
+            self.hash.update(data)
+        self.f.write(data)
+
+    def tell(self):
+        return self.f.tell()
+
+    def restart(self):
+        """Discard everything written so far.
+        """
+        self.f.seek(0)
+        self.f.truncate()
+        if self.hash is not None:
+            self.hash = hashlib.new(self.algorithm)
+
+    def hexdigest(self):
+        return self.hash.hexdigest() if self.hash is not None else None
+
+
 class MyHTTPException(Exception):
     pass
 
@@ -87,15 +602,21 @@ class MyHTTPTimeoutException(Exception):
     pass
 
 
-def download_from_snapshot(url):
+def download_from_snapshot(url, f=None):
     """Download a file from snapshot.d.o.
     https://salsa.debian.org/josch/metasnap/-/blob/master/run.py
+
+    If f (a StreamWriter) is given the content is streamed to it and nothing
+    is returned, otherwise the content is returned.
     """
-    f = BytesIO()
+    if f is None:
+        buf = BytesIO()
+        download_from_snapshot(url, StreamWriter(buf))
+        return buf.getvalue()
     maxretries = 10
     for retrynum in range(maxretries):
         try:
-            c = pycurl.Curl()
+            c = get_curl()
             c.setopt(
                 c.URL,
                 url,
@@ -123,32 +644,26 @@ def download_from_snapshot(url):
             # c.setopt(c.RESOLVE, ["snapshot.debian.org:80:185.17.185.185"])
             if f.tell() != 0:
                 c.setopt(pycurl.RESUME_FROM, f.tell())
-            c.setopt(c.WRITEDATA, f)
-            c.perform()
+            c.setopt(c.WRITEFUNCTION, f.write)
+            snapshot_limiter.acquire()
+            with host_semaphore(url):
+                try:
+                    c.perform()
+                finally:
+                    count_connections(1, c.getinfo(pycurl.NUM_CONNECTS))
             if c.getinfo(c.RESPONSE_CODE) == 404:
                 raise MyHTTP404Exception("got HTTP 404 for %s" % url)
             elif c.getinfo(c.RESPONSE_CODE) not in [200, 206]:
                 raise MyHTTPException(
                     "got HTTP %d for %s" % (c.getinfo(c.RESPONSE_CODE), url)
                 )
-            c.close()
-            # if the requests finished too quickly, sleep the remaining time
-            # s/r  r/h
-            # 3    1020
-            # 2.5  1384
-            # 2.4  1408
-            # 2    1466
-            # 1.5  2267
-            seconds_per_request = 1.5
-            global last_request
-            if last_request is not None:
-                sleep_time = seconds_per_request - (time.time() - last_request)
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-            last_request = time.time()
-            return f.getvalue()
+            return
         except pycurl.error as e:
             code, message = e.args
+            if code == pycurl.E_RANGE_ERROR and retrynum < maxretries - 1:
+                # the server cannot resume, start from the beginning
+                f.restart()
+                continue
             if code in [
                 pycurl.E_PARTIAL_FILE,
                 pycurl.E_COULDNT_CONNECT,
@@ -171,7 +686,7 @@ def download_from_snapshot(url):
             time.sleep(sleep_time)
             # restart from the beginning or otherwise, the result might
             # include a varnish cache error message
-            f = BytesIO()
+            f.restart()
     raise Exception("failed too often...")
 
 
@@ -202,15 +717,12 @@ def retrieve_page(url, snap=False):
             return False, error_msg, m
     else:
         try:
-            session = requests.Session()
-            retry = Retry(connect=5, backoff_factor=0.5)
-            adapter = HTTPAdapter(max_retries=retry)
-            session.mount('http://', adapter)
-            session.mount('https://', adapter)
+            session = get_session()
 
             error_msg = {}
 
-            with closing(session.get(url, stream=True)) as resp:
+            with host_semaphore(url), \
+                    closing(session.get(url, stream=True)) as resp:
                 if resp.status_code != 200:
                     m = '{0}: Error during requests to {1} : status {2}'.format(
                         str(datetime.datetime.now()),
@@ -235,21 +747,189 @@ def retrieve_page(url, snap=False):
             return False, error_msg, m
 
 
-def download_file(url, dir_name, snap=False):
-    """Download file (usually .dsc, .tar.xz, and .debian.tar.xz).
+def fetch_error(url, reason, phase='retrieving the url'):
+    """Create the error of a failed download like retrieve_page does.
     """
-    status, result, message = retrieve_page(url, snap=snap)
+    m = '{}: Error during requests to {} : {}'.format(
+        str(datetime.datetime.now()), url, reason
+    )
+    error_msg = {
+        'phase': phase,
+        'message': 'Url {}: {}'.format(url, reason)
+    }
+    return False, error_msg, m
 
-    if not status:
-        return status, result, message
 
+def fetch_to_file(url, f, snap=False):
+    """Stream url to f (a StreamWriter) without keeping it in memory.
+    If f already contains a partial download, the download resumes from its
+    end.
+
+    Returns:
+        status, error (dict), log message like retrieve_page.
+    """
+    if snap:
+        try:
+            download_from_snapshot(url, f)
+            return True, None, None
+        except:
+            return fetch_error(url, 'status Failed')
+    if not url.startswith(('http://', 'https://')):
+        # A local mirror
+        path = url[len('file://'):] if url.startswith('file://') else url
+        try:
+            with open(path, 'rb') as src:
+                src.seek(f.tell())
+                for chunk in iter(lambda: src.read(f.chunk_size), b''):
+                    f.write(chunk)
+            return True, None, None
+        except OSError as e:
+            return fetch_error(url, 'error {}'.format(str(e)))
+    try:
+        headers = {}
+        if f.tell() != 0:
+            headers['Range'] = 'bytes={}-'.format(f.tell())
+        with host_semaphore(url), closing(get_session().get(
+                url, stream=True, headers=headers)) as resp:
+            if resp.status_code == 416 and f.tell() != 0:
+                # Nothing to resume: the partial download is complete if it
+                # has the size of the file, start again otherwise
+                total = resp.headers.get('Content-Range', '').rpartition('/')
+                if total[2] == str(f.tell()):
+                    return True, None, None
+                f.restart()
+                return fetch_to_file(url, f, snap=snap)
+            if resp.status_code == 200 and f.tell() != 0:
+                f.restart()
+            elif resp.status_code not in (200, 206):
+                return fetch_error(url, 'status {}'.format(resp.status_code))
+            for chunk in resp.iter_content(chunk_size=f.chunk_size):
+                f.write(chunk)
+        return True, None, None
+    except RequestException as e:
+        return fetch_error(url, 'error {}'.format(str(e)))
+
+
+def download_file(url, dir_name, snap=False, cache=None, checksum=None,
+                  stats=None):
+    """Download file (usually .dsc, .tar.xz, and .debian.tar.xz).
+
+    The file is streamed to a .part file that is renamed when the download
+    is completed and its checksum (if known) is verified. A left over .part
+    file is resumed, or renamed if it is already complete; if its checksum
+    does not match, it is removed and the file is downloaded again. If a
+    cache is given, the file is hardlinked from the cache when possible, and
+    it is added to the cache otherwise.
+    """
     unquoted_url = urllib.parse.unquote(url[url.rfind('/')+1:])
     filename = '{}/{}'.format(dir_name, unquoted_url)
-    with open(filename, 'wb') as f:
-        f.write(result)
+    key = cache_key(url, checksum)
+    if cache is not None:
+        counter = 'hits' if cache.fetch(key, filename, checksum) else 'misses'
+        if stats is not None:
+            with stats_lock:
+                stats[counter] = stats.get(counter, 0) + 1
+        if counter == 'hits':
+            return True, None, None
+
+    part = filename + '.part'
+    algorithm = checksum[0] if checksum is not None and checksum[1] else None
+    expected = None
+    if algorithm is not None and str(checksum[2]).isdigit():
+        expected = int(checksum[2])
+    while True:
+        with open(part, 'a+b') as f:
+            writer = StreamWriter(f, algorithm)
+            resumed = writer.tell() != 0
+            if resumed and expected is not None and writer.tell() >= expected:
+                # Left over by a download that was not renamed
+                status, result, message = True, None, None
+            else:
+                status, result, message = fetch_to_file(
+                    url, writer, snap=snap
+                )
+            size = writer.tell()
+
+        if not status:
+            return status, result, message
+
+        if algorithm is None or (
+                writer.hexdigest() == checksum[1] and
+                str(size) == checksum[2]):
+            break
+        os.remove(part)
+        if not resumed:
+            return fetch_error(
+                url, '{} checksum mismatch'.format(algorithm),
+                'verify checksum'
+            )
+        # The left over .part file was not the start of this file
+    os.replace(part, filename)
+    if cache is not None:
+        cache.store(key, filename)
     return True, None, None
 
 
+def download_files(urls, dir_name, snap=False, cache=None, stats=None,
+                   checksums=None):
+    """Download the files of a source package. The .dsc is downloaded first
+    so that the checksums of the rest files can be used as cache keys, then
+    the rest files are downloaded in parallel (up to fetch_jobs at a time).
+    The downloads that have not started are cancelled on the first failure.
+
+    Args:
+        checksums: already known checksums (e.g. from the SourcesIndex),
+            filename -> (algorithm, digest, size)
+    """
+    dscs = [x for x in urls if x.endswith('.dsc')]
+    rest = [x for x in urls if not x.endswith('.dsc')]
+    status, result, m = True, None, None
+    checksums = dict(checksums) if checksums else {}
+    for url in dscs:
+        name = urllib.parse.unquote(url[url.rfind('/')+1:])
+        status, result, m = download_file(
+            url, dir_name, snap=snap, cache=cache,
+            checksum=checksums.get(name), stats=stats
+        )
+        if not status:
+            return status, result, m
+        for k, v in parse_dsc_checksums(
+                '{}/{}'.format(dir_name, name)).items():
+            checksums.setdefault(k, v)
+
+    counts = getattr(connection_counts, 'counts', None)
+
+    def fetch(url):
+        name = urllib.parse.unquote(url[url.rfind('/')+1:])
+        track_connections(counts)
+        try:
+            return download_file(
+                url, dir_name, snap=snap, cache=cache,
+                checksum=checksums.get(name), stats=stats
+            )
+        finally:
+            track_connections(None)
+
+    if fetch_jobs > 1 and len(rest) > 1:
+        with ThreadPoolExecutor(max_workers=fetch_jobs) as executor:
+            futures = [executor.submit(fetch, url) for url in rest]
+            try:
+                for future in as_completed(futures):
+                    status, result, m = future.result()
+                    if not status:
+                        return status, result, m
+            finally:
+                # Do not start the downloads still queued after a failure
+                for future in futures:
+                    future.cancel()
+    else:
+        for url in rest:
+            status, result, m = fetch(url)
+            if not status:
+                return status, result, m
+    return status, result, m
+
+
 def parse_page_snap(page):
     """Parses a Debian Snapshot HTML page and parses the sources URLs.
     """
@@ -262,7 +942,7 @@ def parse_page_snap(page):
     return urls
 
 
-def download_snap(source, version, dir_name):
+def download_snap(source, version, dir_name, cache=None, stats=None):
     url = snap_url.format(
         source, urllib.parse.quote(version)
     )
@@ -276,13 +956,10 @@ def download_snap(source, version, dir_name):
     create_dir(dir_name)
 
     # Download the files
-    for source_file_url in urls:
-        status, result, m = download_file(
-            download_url.format(source_file_url), dir_name, snap=True
-        )
-        if not status:
-            return status, result, m
-    return status, result, m
+    return download_files(
+        [download_url.format(x) for x in urls], dir_name, snap=True,
+        cache=cache, stats=stats
+    )
 
 
 def find_deb_prefix(name):
@@ -307,7 +984,412 @@ def parse_page_deb(page, source, version, prefix):
     return [deb_url.format(prefix, source, x) for x in result]
 
 
-def download_deb(source, version, dir_name):
+class SourcesIndex():
+    """A persistent index of the Sources files of the Debian archive.
+
+    It maps (dist, source, version) to the directory of the source package in
+    the pool and to its files with their sizes and checksums, so the pool
+    directory listings do not have to be scraped. Every component of a dist
+    is indexed. The index of a dist is refreshed when it is older than ttl
+    seconds, and a component is downloaded again only if its Sources file has
+    changed. The mirror can also be a local copy of the archive (a path or a
+    file:// URL).
+    """
+    # Version of the schema, older indexes are rebuilt
+    SCHEMA_VERSION = 1
+
+    def __init__(self, directory, ttl, components=SOURCES_COMPONENTS,
+                 log=print):
+        self.directory = create_dir(directory)
+        self.ttl = ttl
+        self.components = components
+        self.log = log
+        self.lock = threading.Lock()
+        # Dists that are being refreshed, by one thread at a time
+        self.refreshing = set()
+        self.db = sqlite3.connect(
+            os.path.join(directory, 'sources.db'), check_same_thread=False
+        )
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.db.executescript("""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS meta;
+                PRAGMA user_version = {};
+            """.format(self.SCHEMA_VERSION))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                dist TEXT, component TEXT, source TEXT, version TEXT,
+                plain_version TEXT, directory TEXT, name TEXT, size TEXT,
+                sha256 TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_idx
+                ON files (dist, source, plain_version);
+            CREATE TABLE IF NOT EXISTS meta (
+                dist TEXT, component TEXT, etag TEXT, last_modified TEXT,
+                checked REAL, PRIMARY KEY (dist, component)
+            );
+        """)
+
+    def lookup(self, dist, source, version):
+        """Return the pool directory of a source package and its files
+        (name -> (algorithm, digest, size)), or None if it is not indexed.
+        """
+        self._refresh(dist)
+        try:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT version, directory, name, size, sha256 FROM files "
+                    "WHERE dist = ? AND source = ? AND plain_version = ?",
+                    (dist, source, version.split(':', 1)[-1])
+                ).fetchall()
+        except sqlite3.Error as e:
+            self.log("Cannot read the index of {}: {}".format(dist, e))
+            return None
+        # Prefer an exact match when the version has an epoch
+        exact = [r for r in rows if r[0] == version]
+        rows = exact if exact else rows
+        if not rows:
+            return None
+        files = {r[2]: ('sha256', r[4], r[3]) for r in rows}
+        return rows[0][1], files
+
+    def _refresh(self, dist):
+        """Refresh the index of a dist if it is older than ttl.
+
+        The Sources files are downloaded and parsed without holding the
+        lock; meanwhile the other threads use the old index.
+        """
+        with self.lock:
+            if dist in self.refreshing:
+                return
+            try:
+                meta = {
+                    row[0]: row[1:] for row in self.db.execute(
+                        "SELECT component, etag, last_modified, checked "
+                        "FROM meta WHERE dist = ?", (dist,)
+                    )
+                }
+            except sqlite3.Error as e:
+                self.log("Cannot read the index of {}: {}".format(dist, e))
+                return
+            checked = min(
+                meta.get(c, ('', '', 0))[2] for c in self.components
+            )
+            if time.time() - checked < self.ttl:
+                return
+            self.refreshing.add(dist)
+        try:
+            for component in self.components:
+                etag, last_modified, _ = meta.get(component, ('', '', 0))
+                self._refresh_component(dist, component, etag, last_modified)
+        finally:
+            with self.lock:
+                self.refreshing.discard(dist)
+
+    def _refresh_component(self, dist, component, etag, last_modified):
+        path = os.path.join(
+            self.directory, '{}.{}.Sources.xz'.format(dist, component)
+        )
+        url = '{}/dists/{}/{}/source/Sources.xz'.format(
+            deb_mirror, dist, component
+        )
+        changed, rows = False, []
+        try:
+            changed, new_etag, new_last_modified = self._fetch(
+                url, path, etag, last_modified
+            )
+            if changed:
+                rows = list(self._parse(dist, component, path))
+            etag, last_modified = new_etag, new_last_modified
+        except (OSError, RequestException, lzma.LZMAError, EOFError) as e:
+            # Keep using the old index and try again after ttl; the packages
+            # that are not in the index are found by scraping the pool
+            self.log("Cannot refresh the index of {}/{}: {}".format(
+                dist, component, e
+            ))
+            changed = False
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        try:
+            with self.lock, self.db:
+                if changed:
+                    self.db.execute(
+                        "DELETE FROM files WHERE dist = ? AND component = ?",
+                        (dist, component)
+                    )
+                    self.db.executemany(
+                        "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows
+                    )
+                self.db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?)",
+                    (dist, component, etag, last_modified, time.time())
+                )
+        except sqlite3.Error as e:
+            self.log("Cannot update the index of {}/{}: {}".format(
+                dist, component, e
+            ))
+
+    def _fetch(self, url, path, etag, last_modified):
+        """Download url to path if it has changed since the last time.
+
+        Returns:
+            changed (bool), etag, last_modified
+        """
+        if not url.startswith(('http://', 'https://')):
+            local = url[len('file://'):] if url.startswith('file://') else url
+            mtime = str(os.path.getmtime(local))
+            if mtime == last_modified:
+                return False, etag, last_modified
+            shutil.copyfile(local, path)
+            return True, '', mtime
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        with host_semaphore(url), closing(get_session().get(
+                url, stream=True, headers=headers)) as resp:
+            if resp.status_code == 304:
+                return False, etag, last_modified
+            resp.raise_for_status()
+            with open(path, 'wb') as f:
+                writer = StreamWriter(f)
+                for chunk in resp.iter_content(chunk_size=writer.chunk_size):
+                    writer.write(chunk)
+            return (
+                True,
+                resp.headers.get('ETag', ''),
+                resp.headers.get('Last-Modified', '')
+            )
+
+    def _parse(self, dist, component, path):
+        """Yield the rows of the files table from a Sources.xz file.
+        """
+        with lzma.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+            fields = {}
+            field = None
+            for line in f:
+                line = line.rstrip('\n')
+                if line == '':
+                    yield from self._paragraph_rows(dist, component, fields)
+                    fields = {}
+                    field = None
+                elif line[0] in ' \t' and field is not None:
+                    fields[field].append(line.strip())
+                elif ':' in line:
+                    field, value = line.split(':', 1)
+                    fields[field] = [value.strip()]
+            yield from self._paragraph_rows(dist, component, fields)
+
+    @staticmethod
+    def _paragraph_rows(dist, component, fields):
+        if 'Package' not in fields or 'Version' not in fields:
+            return
+        source = fields['Package'][0]
+        version = fields['Version'][0]
+        directory = fields.get('Directory', [''])[0]
+        checksums = fields.get('Checksums-Sha256', [])
+        for line in checksums:
+            parts = line.split()
+            if len(parts) != 3:
+                continue
+            yield (
+                dist, component, source, version, version.split(':', 1)[-1],
+                directory, parts[2], parts[1], parts[0]
+            )
+
+
+# Retry windows of the failures (in seconds): the first retry is allowed
+# after the base window, and the window doubles up to the maximum
+TRANSIENT_BACKOFF = (600, 6 * 3600)
+FAILURE_BACKOFF = (24 * 3600, 30 * 24 * 3600)
+# Phases of the errors of downloads, which may succeed later (a checksum
+# mismatch is usually a truncated or corrupted transfer)
+TRANSIENT_PHASES = ('retrieving the url', 'find deb prefix', 'verify checksum')
+# Files of the analyzer whose content changes the results
+ANALYZER_FILES = [
+    '/usr/local/bin/analyzer',
+    '/usr/local/bin/base_analyzer',
+    '/usr/local/bin/fcan',
+    os.path.expanduser('~/.sbuildrc'),
+]
+# Large binaries of the analyzer, identified by their size and mtime
+ANALYZER_BINARIES = [
+    '/usr/local/bin/cscout',
+]
+
+
+def compute_analyzer_digest(files=ANALYZER_FILES, binaries=ANALYZER_BINARIES):
+    """Return a digest of the files of the analyzer that exist.
+    """
+    digest = hashlib.sha256()
+    for path in files:
+        try:
+            with open(path, 'rb') as f:
+                content = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            continue
+        digest.update('{}:{}\n'.format(path, content).encode('utf-8'))
+    for path in binaries:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        digest.update('{}:{}:{}\n'.format(
+            path, stat.st_size, stat.st_mtime_ns
+        ).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def write_json_atomic(path, data):
+    """Write a JSON file atomically, so that concurrent readers see either
+    the old or the new content.
+    """
+    create_dir(os.path.dirname(path))
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def publish_file(src, dst):
+    """Move a staged file to dst atomically. On another filesystem it is
+    copied next to dst first, and the copy is renamed.
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp = '{}.{}.{}.tmp'.format(dst, os.getpid(), threading.get_ident())
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.remove(src)
+
+
+class ResultsManifest():
+    """A record of the releases that have been analyzed successfully.
+
+    Every entry is a JSON file named after the fingerprint of the inputs of
+    the analysis, with the payloads of the call graphs saved in the results
+    directory. Entries are written atomically, so the manifest can be
+    shared by the plugins that use the same directory.
+    """
+    def __init__(self, directory):
+        self.directory = create_dir(directory)
+
+    def _path(self, fingerprint):
+        return os.path.join(self.directory, fingerprint[:2],
+                            fingerprint + '.json')
+
+    def lookup(self, fingerprint):
+        """Return the entry of a fingerprint, or None if it does not exist or
+        if any of its call graphs has been removed.
+        """
+        try:
+            with open(self._path(fingerprint), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not entry.get('payloads'):
+            return None
+        for payload in entry['payloads']:
+            if not os.path.isfile(payload.get('dir', '')):
+                return None
+        return entry
+
+    def record(self, fingerprint, entry):
+        write_json_atomic(self._path(fingerprint), entry)
+
+
+class FailureStore():
+    """A record of the releases whose analysis failed, and of when they may
+    be analyzed again.
+
+    Every entry is a JSON file named after a key of the inputs, with the
+    phase, type, and message of the last error. The window before the next
+    retry doubles with every consecutive failure: it starts small for the
+    transient errors (downloads), and large for the errors of the builds,
+    which fail again unless the inputs change.
+    """
+    def __init__(self, directory):
+        self.directory = create_dir(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def lookup(self, key):
+        try:
+            with open(self._path(key), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def blocked(self, key, now=None):
+        """Return the entry of a key if its retry window has not ended yet,
+        None otherwise.
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        if now is None:
+            now = time.time()
+        if now >= entry.get('retry_after', 0):
+            return None
+        return entry
+
+    def record(self, key, error, transient, now=None):
+        """Record a failure, and return its entry.
+        """
+        if now is None:
+            now = time.time()
+        previous = self.lookup(key) or {}
+        failures = previous.get('failures', 0) + 1
+        base, cap = TRANSIENT_BACKOFF if transient else FAILURE_BACKOFF
+        delay = min(base * 2 ** (failures - 1), cap)
+        entry = {
+            'phase': error.get('phase', ''),
+            'type': error.get('type', ''),
+            'message': error.get('message', ''),
+            'transient': transient,
+            'failures': failures,
+            'first_failure': previous.get('first_failure', now),
+            'last_failure': now,
+            'retry_after': now + delay
+        }
+        write_json_atomic(self._path(key), entry)
+        return entry
+
+    def clear(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+def download_deb(source, version, dir_name, cache=None, stats=None,
+                 dist=None, index=None):
+    # Find urls in the index of the archive
+    if index is not None and dist:
+        entry = index.lookup(dist, source, version)
+        if entry is not None:
+            directory, checksums = entry
+            create_dir(dir_name)
+            urls = [
+                '{}/{}/{}'.format(deb_mirror, directory, x)
+                for x in sorted(checksums)
+            ]
+            return download_files(
+                urls, dir_name, cache=cache, stats=stats, checksums=checksums
+            )
     prefix = find_deb_prefix(source)
     if prefix is False:
         error_msg = {}
@@ -330,28 +1412,194 @@ def download_deb(source, version, dir_name):
     create_dir(dir_name)
 
     # Download the files
-    for source_file_url in urls:
-        status, result, m = download_file(source_file_url, dir_name)
-        if not status:
-            return status, result, m
-    return status, result, m
+    return download_files(urls, dir_name, cache=cache, stats=stats)
 
 
-def download(source, version, dir_name):
+def download(source, version, dir_name, cache=None, stats=None, dist=None,
+             index=None):
     """Download the debian source package file (.dsc) and the tar of project
     """
-    status, result, m = download_snap(source, version, dir_name)
+    status, result, m = download_snap(
+        source, version, dir_name, cache=cache, stats=stats
+    )
     status = False
     if status:
         return status, result, m
-    status, result, m = download_deb(source, version, dir_name)
+    status, result, m = download_deb(
+        source, version, dir_name, cache=cache, stats=stats, dist=dist,
+        index=index
+    )
     return status, result, m
 
 
+class JSONScanner():
+    """Scan the top level object of a JSON file chunk by chunk, skipping the
+    values that are not needed without parsing them.
+    """
+    chunk_size = 1024 * 1024
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            raise ValueError("Unexpected end of JSON file")
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Skip whitespace and return the next character.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected {!r} in JSON file".format(char))
+        self.pos += 1
+
+    def decode(self):
+        """Decode a (small) value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                self.fill()
+                continue
+            # A number may continue in the next chunk
+            if end == len(self.buf) or self.buf[end] in '.eE+-0123456789':
+                try:
+                    self.fill()
+                    continue
+                except ValueError:
+                    pass
+            self.pos = end
+            return value
+
+    def skip(self):
+        """Skip a value.
+        """
+        if self.peek() not in '{[':
+            self.decode()
+            return
+        depth = 0
+        while True:
+            # The brackets up to the next string
+            quote = self.buf.find('"', self.pos)
+            end = quote if quote != -1 else len(self.buf)
+            part = self.buf[self.pos:end]
+            delta = part.count('{') + part.count('[') - \
+                part.count('}') - part.count(']')
+            if depth + delta <= 0:
+                # The value ends in this part
+                for i, char in enumerate(part):
+                    if char in '{[':
+                        depth += 1
+                    elif char in '}]':
+                        depth -= 1
+                        if depth == 0:
+                            self.pos += i + 1
+                            return
+            depth += delta
+            self.pos = end
+            if quote == -1:
+                self.fill()
+            else:
+                self.pos += 1
+                self.skip_string()
+
+    def skip_string(self):
+        """Skip the rest of a string.
+        """
+        while True:
+            quote = self.buf.find('"', self.pos)
+            if quote == -1:
+                # Keep a trailing backslash with the escaped character
+                self.pos = len(self.buf.rstrip('\\'))
+                self.fill()
+                continue
+            backslashes = quote - len(self.buf[self.pos:quote].rstrip('\\')) \
+                - self.pos
+            self.pos = quote + 1
+            if backslashes % 2 == 0:
+                return
+
+
+def read_json_fields(filename, fields):
+    """Read some fields of the top level object of a JSON file, without
+    loading the rest of it.
+
+    Returns:
+        A dict with the fields that have been found.
+    """
+    found = {}
+    with open(filename, 'r') as f:
+        scanner = JSONScanner(f)
+        scanner.expect('{')
+        if scanner.peek() == '}':
+            return found
+        while len(found) < len(fields):
+            key = scanner.decode()
+            scanner.expect(':')
+            if key in fields:
+                found[key] = scanner.decode()
+            else:
+                scanner.skip()
+            if scanner.peek() == '}':
+                break
+            scanner.expect(',')
+    return found
+
+
+class RawMessage(str):
+    """A message already serialized to JSON.
+    """
+
+
+def splice_payload(message, filename, extra):
+    """Serialize a message with the JSON object of a file as its payload,
+    adding the extra fields to the object without parsing it.
+
+    Returns:
+        A RawMessage.
+    """
+    with open(filename, 'r') as f:
+        payload = f.read().rstrip()
+    if not payload.endswith('}'):
+        raise ValueError("Not a JSON object: " + filename)
+    payload = payload[:-1].rstrip()
+    fields = json.dumps(extra)[1:]
+    if not payload.endswith('{'):
+        fields = ', ' + fields
+    message = dict(message, payload=None)
+    head = json.dumps(message)
+    head = head[:-len('null}')]
+    return RawMessage(''.join((head, payload, fields, '}')))
+
+
+def _release_key(record):
+    """Return the (source, release, version, arch) of a record.
+    """
+    record = record.get("payload", record)
+    return tuple(
+        record.get(key) for key in ('source', 'release', 'version', 'arch')
+    )
+
+
 class PackageState():
     """A structure that contains the state for a package.
     """
-    def __init__(self, record):
+    def __init__(self, record, work_dir=''):
         record = record.get("payload", record)
         if record.get("dsc"):
             record.pop("dsc")
@@ -361,9 +1609,9 @@ class PackageState():
         self.dist = record['release']
         self.arch = record['arch']
         self.forge = record.get('forge', 'debian')
-        self.dir_name = '{}-{}-{}-{}'.format(
+        self.dir_name = os.path.join(work_dir, '{}-{}-{}-{}'.format(
             self.source, self.dist, self.arch, self.version
-        )
+        ))
         self.callgraph_dir = '/{}/{}/{}/{}/{}/'.format(
             'callgraphs', self.source, self.dist, self.version, self.arch
         )
@@ -374,9 +1622,23 @@ class PackageState():
             self.source[0], self.source, self.version
         )
         self.urls = []
-        self.profiling_data = {'times': {}}
+        self.profiling_data = {
+            'times': {}, 'cache': {'hits': 0, 'misses': 0}
+        }
         self.binary_pkgs = []
-        self.old_cwd = os.getcwd()
+        self.prefetch_error = None
+        # Events of the analyzer read so far, the binary packages whose
+        # call graphs have been produced while building, and their messages,
+        # held until sbuild has succeeded
+        self.events_offset = 0
+        self.pushed = set()
+        self.held = []
+        # Fingerprint of the inputs, and payloads of the call graphs saved in
+        # the results directory
+        self.fingerprint = None
+        self.payloads = []
+        # The error is a known failure whose retry window has not ended
+        self.skipped = False
         self.err = {'error': {'phase': '', 'message': '', 'crashed': False}}
         self.error_msg = self.err['error']
         self.status = ""
@@ -392,11 +1654,127 @@ class PackageState():
         )
 
 
+class OffsetTracker():
+    """Keep track of the records that are processed concurrently, to commit
+    only the offsets up to which all the records of a partition are done.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # partition -> offsets in consumption order
+        self.done = {}  # partition -> set of done offsets
+
+    def add(self, partition, offset):
+        with self.lock:
+            self.pending.setdefault(partition, []).append(offset)
+            self.done.setdefault(partition, set())
+
+    def complete(self, partition, offset):
+        with self.lock:
+            # The partition may have been revoked in the meantime
+            if partition in self.done:
+                self.done[partition].add(offset)
+
+    def committable(self):
+        """Return the offsets to commit (partition -> OffsetAndMetadata).
+        """
+        offsets = {}
+        with self.lock:
+            for partition, pending in self.pending.items():
+                last = None
+                while pending and pending[0] in self.done[partition]:
+                    last = pending.pop(0)
+                    self.done[partition].discard(last)
+                if last is not None:
+                    offsets[partition] = OffsetAndMetadata(last + 1, None)
+        return offsets
+
+    def forget(self, partitions):
+        """Stop tracking revoked partitions.
+        """
+        with self.lock:
+            for partition in partitions:
+                self.pending.pop(partition, None)
+                self.done.pop(partition, None)
+
+    def in_flight(self):
+        with self.lock:
+            return sum(len(x) for x in self.pending.values())
+
+
+def read_int(path):
+    try:
+        with open(path, 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def memory_info():
+    """Return the memory limit and the available memory (in bytes) of the
+    container, as reported by its cgroup or by /proc/meminfo.
+    """
+    meminfo = {}
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    total = meminfo.get('MemTotal')
+    available = meminfo.get('MemAvailable', total)
+    # cgroup v2 and cgroup v1
+    for limit_path, usage_path in (
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+             '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        limit = read_int(limit_path)
+        usage = read_int(usage_path)
+        if limit is not None and (total is None or limit < total):
+            total = limit
+            if usage is not None:
+                available = min(available or limit, limit - usage)
+            break
+    return total, available
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class RebalanceListener(ConsumerRebalanceListener):
+    """Drop the prefetched records of the partitions that are revoked from
+    the consumer.
+    """
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def on_partitions_revoked(self, revoked):
+        if getattr(self.plugin, 'tracker', None) is not None:
+            self.plugin.drop_partitions(set(revoked))
+
+    def on_partitions_assigned(self, assigned):
+        pass
+
+
 class CScoutKafkaPlugin(KafkaPlugin):
     """Produce C call graphs from Debian package releases.
     """
     def __init__(self, bootstrap_servers, consume_topic, produce_topic,
-                 log_topic, error_topic, group_id, directory, debug):
+                 log_topic, error_topic, group_id, directory, debug,
+                 cache_dir='', cache_size=0, index_dir='', index_ttl=0,
+                 workers=1, worker_memory=0, prefetch=0, prefetch_disk=0,
+                 cg_format='json', compression=None, inline_max_bytes=0,
+                 spill_directory='', metrics_port=0, metrics_textfile='',
+                 apt_cache_dir='', apt_cache_size=0, force_rebuild=False,
+                 analyzer_digest='', failures_dir=''):
         super().__init__(bootstrap_servers)
         self.consume_topic = consume_topic
         self.produce_topic = produce_topic
@@ -405,6 +1783,39 @@ class CScoutKafkaPlugin(KafkaPlugin):
         self.group_id = group_id
         self.directory = directory
         self.debug = debug
+        # Number of records to process concurrently, and the memory budget
+        # (in bytes) of each one of them
+        self.worker_memory = worker_memory * 1024 * 1024
+        self.workers = max(1, workers)
+        if self.workers > 1 and self.worker_memory > 0:
+            limit, _ = memory_info()
+            if limit is not None:
+                self.workers = max(
+                    1, min(self.workers, limit // self.worker_memory)
+                )
+        # Number of records to download ahead, and the disk quota (in bytes)
+        # of their sources
+        self.prefetch = max(0, prefetch)
+        self.prefetch_disk = prefetch_disk * 1024 * 1024
+        # Disk space reserved by the prefetched records, their expected size
+        # until their download is done and their size afterwards
+        self.prefetch_reserved = 0
+        self.prefetch_sizes = [0, 0]  # number and total size of the downloads
+        self.prefetch_lock = threading.Lock()
+        self.tracker = None
+        # Format of the call graphs saved in directory: json, compact, or both
+        self.cg_format = cg_format
+        # Call graphs larger than inline_max_bytes are saved in
+        # spill_directory instead of being sent
+        self.compression = compression
+        self.inline_max_bytes = inline_max_bytes
+        self.spill_directory = spill_directory
+        self.max_request_size = max(1048576, inline_max_bytes + 65536)
+        self.produced = {}
+        self.metrics_textfile = metrics_textfile
+        self.lag_checked = 0
+        if metrics_port:
+            registry.serve(metrics_port)
         if not debug:
             self.set_consumer()
             self.set_producer()
@@ -414,7 +1825,33 @@ class CScoutKafkaPlugin(KafkaPlugin):
             self.log_topic = "log_topic"
             self.error_topic = "error_topic"
             os.makedirs("debug", exist_ok=True)
-        # State per package
+        # Local cache of source files
+        self.cache = None
+        if cache_dir != '':
+            self.cache = SourceCache(cache_dir, cache_size * 1024 * 1024)
+        # Archives of the packages installed in the chroots, shared by all the
+        # builds and pruned to apt_cache_size bytes
+        self.apt_cache_dir = apt_cache_dir
+        self.apt_cache_size = apt_cache_size * 1024 * 1024
+        # Results of the releases analyzed before, reused unless
+        # force_rebuild is set
+        self.manifest = None
+        if directory != '':
+            self.manifest = ResultsManifest(
+                os.path.join(directory, 'manifest')
+            )
+        self.force_rebuild = force_rebuild
+        self.analyzer_digest = analyzer_digest or compute_analyzer_digest()
+        # Releases that failed, skipped until their retry window ends
+        self.failures = None
+        if failures_dir != '':
+            self.failures = FailureStore(failures_dir)
+        # Index of the Sources files of the archive
+        self.index = None
+        if index_dir != '':
+            self.index = SourcesIndex(index_dir, index_ttl, log=self.log)
+        # State per package, every worker has its own
+        self.local = threading.local()
         self.state = None
 
     def name(self):
@@ -429,12 +1866,279 @@ class CScoutKafkaPlugin(KafkaPlugin):
     def free_resource(self):
         pass
 
+    @property
+    def state(self):
+        return getattr(self.local, 'state', None)
+
+    @state.setter
+    def state(self, state):
+        self.local.state = state
+
+    def set_producer(self):
+        """Set a producer that compresses the batches of messages.
+        """
+        self.producer = KafkaProducer(
+            bootstrap_servers=self.bootstrap_servers.split(','),
+            compression_type=self.compression,
+            max_request_size=self.max_request_size,
+            value_serializer=lambda x: x.encode('utf-8')
+        )
+
+    def produced_metrics(self):
+        """Return the number of messages and bytes (before compression)
+        produced to every topic.
+        """
+        with stats_lock:
+            return {k: dict(v) for k, v in self.produced.items()}
+
+    def set_consumer(self):
+        """Set a consumer without auto commit when records are processed
+        concurrently or prefetched, its offsets are committed by
+        consume_messages.
+        """
+        if self.workers == 1 and self.prefetch == 0:
+            super().set_consumer()
+            return
+        self.consumer = KafkaConsumer(
+            bootstrap_servers=self.bootstrap_servers.split(','),
+            auto_offset_reset='earliest',
+            enable_auto_commit=False,
+            max_poll_records=self.workers + self.prefetch,
+            group_id=self.group_id,
+            value_deserializer=lambda x: json.loads(x.decode('utf-8'))
+        )
+        self.consumer.subscribe(
+            [self.consume_topic], listener=RebalanceListener(self)
+        )
+
+    def consume_messages(self):
+        """Consume messages with a pool of workers, and download the sources
+        of the next records while the current ones are being built.
+
+        The offset of a record is committed only when it and all the
+        previous records of its partition have been processed. A record
+        waits in the queue while another record of the same release is
+        being built, because they share the directory of the call graphs.
+        """
+        if self.workers == 1 and self.prefetch == 0:
+            super().consume_messages()
+            return
+        self.tracker = OffsetTracker()
+        # Consumed records waiting for a worker:
+        # [partition, offset, record, prefetch future, reserved disk space]
+        self.queue = collections.deque()
+        # Running futures, and the release that each of them builds
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix='worker') as executor, \
+                ThreadPoolExecutor(max_workers=max(1, self.prefetch),
+                                   thread_name_prefix='prefetch') as prefetcher:
+            while True:
+                self._update_lag()
+                for future in [f for f in futures if f.done()]:
+                    del futures[future]
+                    # Crash as the single worker mode does
+                    future.result()
+                self._commit()
+                self._prefetch_queued(prefetcher)
+                free = self.workers - len(futures)
+                if free > 0 and self.worker_memory > 0:
+                    _, available = memory_info()
+                    if futures and available is not None and \
+                            available < self.worker_memory:
+                        free = 0
+                running = set(futures.values())
+                for item in list(self.queue):
+                    if free <= 0:
+                        break
+                    release = _release_key(item[2])
+                    if release in running:
+                        continue
+                    self.queue.remove(item)
+                    self._release_prefetch(item)
+                    partition, offset, record, prefetched = item[:4]
+                    future = executor.submit(
+                        self._consume_queued, partition, offset, record,
+                        prefetched
+                    )
+                    future.add_done_callback(
+                        lambda f, p=partition, o=offset:
+                            self.tracker.complete(p, o)
+                    )
+                    futures[future] = release
+                    running.add(release)
+                    free -= 1
+                wanted = free + self.prefetch - len(self.queue)
+                partitions = self.consumer.assignment()
+                if wanted <= 0:
+                    # Keep polling to stay in the consumer group
+                    self.consumer.pause(*partitions)
+                    self.consumer.poll(timeout_ms=1000)
+                    continue
+                self.consumer.resume(*partitions)
+                records = self.consumer.poll(
+                    timeout_ms=1000, max_records=wanted
+                )
+                for partition, messages in records.items():
+                    for message in messages:
+                        self.tracker.add(partition, message.offset)
+                        self.log("{}: Consuming: {}".format(
+                            str(datetime.datetime.now()), message.value))
+                        self.queue.append(
+                            [partition, message.offset, message.value, None,
+                             None]
+                        )
+
+    def _commit(self):
+        offsets = self.tracker.committable()
+        if not offsets:
+            return
+        try:
+            self.consumer.commit(offsets=offsets)
+        except CommitFailedError as e:
+            # The partitions were reassigned, the records will be consumed
+            # again by their new owner.
+            self.log("{}: Commit failed: {}".format(
+                str(datetime.datetime.now()), str(e)
+            ))
+            self.tracker.forget(list(offsets.keys()))
+
+    def _prefetch_queued(self, prefetcher):
+        """Start downloading the sources of the first queued records, as
+        long as the prefetched sources fit in the disk quota.
+
+        The expected size of a download (the mean size of the previous
+        ones) is reserved when it starts, and replaced with its size when
+        it is done.
+        """
+        for item in list(self.queue)[:self.prefetch]:
+            if item[3] is not None:
+                continue
+            with self.prefetch_lock:
+                if self.prefetch_reserved >= self.prefetch_disk:
+                    break
+                count, total = self.prefetch_sizes
+                item[4] = total // count if count else PREFETCH_EXPECTED_SIZE
+                self.prefetch_reserved += item[4]
+            partition, offset, record = item[:3]
+            item[3] = prefetcher.submit(
+                self.prefetch_sources, record,
+                self._prefetch_dir(partition, offset)
+            )
+            item[3].add_done_callback(
+                lambda f, item=item: self._prefetched(item, f)
+            )
+
+    def _prefetch_dir(self, partition, offset):
+        return os.path.join(
+            os.getcwd(), 'staging', '{}-{}-{}'.format(
+                partition.topic, partition.partition, offset
+            )
+        )
+
+    def _prefetched(self, item, future):
+        """Replace the disk space reserved by a download with its size.
+        """
+        size = 0
+        if not future.cancelled():
+            try:
+                size = directory_size(future.result().dir_name)
+            except Exception:
+                pass
+        with self.prefetch_lock:
+            self.prefetch_sizes[0] += 1
+            self.prefetch_sizes[1] += size
+            # The record may already have been given to a worker
+            if item[4] is not None:
+                self.prefetch_reserved += size - item[4]
+                item[4] = size
+
+    def _release_prefetch(self, item):
+        with self.prefetch_lock:
+            if item[4] is not None:
+                self.prefetch_reserved -= item[4]
+                item[4] = None
+
+    def prefetch_sources(self, record, work_dir):
+        """Download the sources of a record before a worker is available.
+
+        Returns:
+            The PackageState of the record to be passed to consume.
+        """
+        state = PackageState(record, work_dir)
+        self.state = state
+        try:
+            self._skip_known_failure(self._release_key())
+            self.download()
+        except PluginError as e:
+            state.prefetch_error = e
+        self.state = None
+        return state
+
+    def _consume_queued(self, partition, offset, record, prefetched):
+        state = None
+        if prefetched is not None:
+            try:
+                state = prefetched.result()
+            except Exception as e:
+                # Reported as an error of the record
+                state = PackageState(
+                    record, self._prefetch_dir(partition, offset)
+                )
+                state.error_msg['phase'] = 'prefetch'
+                state.error_msg['message'] = str(e)
+                state.error_msg['crashed'] = True
+                state.prefetch_error = PluginError(str(e))
+        self.consume(record, state)
+        if prefetched is not None:
+            shutil.rmtree(
+                self._prefetch_dir(partition, offset), ignore_errors=True
+            )
+
+    def drop_partitions(self, partitions):
+        """Forget the queued records of revoked partitions and remove their
+        prefetched sources.
+        """
+        try:
+            self._commit()
+        except Exception:
+            pass
+        for item in [x for x in self.queue if x[0] in partitions]:
+            self.queue.remove(item)
+            self._release_prefetch(item)
+            future = item[3]
+            if future is not None and not future.cancel():
+                work_dir = self._prefetch_dir(item[0], item[1])
+                future.add_done_callback(
+                    lambda f, d=work_dir: shutil.rmtree(d, ignore_errors=True)
+                )
+        self.tracker.forget(partitions)
+
+    def work_dir(self):
+        """Return the working directory of the current worker.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return ''
+        return os.path.join(
+            os.getcwd(), 'workers', threading.current_thread().name
+        )
+
     def download(self):
         """Download the source code of project
         """
-        status, error, m = download(
-            self.state.source, self.state.version, self.state.dir_name
-        )
+        counts = {'requests': 0, 'new_connections': 0}
+        track_connections(counts)
+        start = time.time()
+        try:
+            status, error, m = download(
+                self.state.source, self.state.version, self.state.dir_name,
+                cache=self.cache, stats=self.state.profiling_data['cache'],
+                dist=self.state.dist, index=self.index
+            )
+        finally:
+            track_connections(None)
+        phase_seconds.observe(time.time() - start, phase='download')
+        self.state.profiling_data['connections'] = connection_metrics(counts)
         if not status:
             self.log(m)
             self.state.error_msg['phase'] = error['phase']
@@ -452,11 +2156,8 @@ class CScoutKafkaPlugin(KafkaPlugin):
             self.state.arch
         )
         self.log(m)
-        # Change working directory to directory with source files
-        os.chdir(self.state.dir_name)
-
         # Find the .dsc file
-        dsc = glob.glob("*.dsc")
+        dsc = glob.glob(os.path.join(self.state.dir_name, "*.dsc"))
         if len(dsc) != 1:
             message = 'Cannot find .dsc file or found multiple'
             m = "{}: {}".format(
@@ -468,7 +2169,7 @@ class CScoutKafkaPlugin(KafkaPlugin):
             self.state.error_msg['message'] = message
             self.state.error_msg['crashed'] = True
             raise PluginError(message)
-        dsc = dsc[0]
+        dsc = os.path.basename(dsc[0])
 
         sbuild_options = [
             'sbuild',
@@ -481,9 +2182,27 @@ class CScoutKafkaPlugin(KafkaPlugin):
             '--arch={}'.format(self.state.arch),
             dsc
         ]
-        # Run sbuild
-        cmd = sp.Popen(sbuild_options, stdout=sp.PIPE, stderr=sp.STDOUT)
+        # Run sbuild, and push the call graphs as soon as they are ready
+        start = time.time()
+        cmd = sp.Popen(
+            sbuild_options, stdout=sp.PIPE, stderr=sp.STDOUT,
+            cwd=self.state.dir_name
+        )
+        done = threading.Event()
+        tail = threading.Thread(
+            target=self._tail_events, args=(self.state, done), daemon=True
+        )
+        tail.start()
         stdout, _ = cmd.communicate()
+        done.set()
+        tail.join()
+        phase_seconds.observe(time.time() - start, phase='sbuild')
+        # The call graphs of a failed build are dropped with their messages
+        held, self.state.held = self.state.held, []
+        if cmd.returncode != 1:
+            for topic, message in held:
+                self.emit_message(topic, message, "succeed", "")
+        self._prune_apt_cache()
         if self.directory != '':
             self._copy_sources()
         if cmd.returncode == 1:
@@ -496,7 +2215,31 @@ class CScoutKafkaPlugin(KafkaPlugin):
             self.state.error_msg['message'] = message
             self.state.error_msg['crashed'] = True
             raise PluginError(message)
-        os.chdir(self.state.old_cwd)
+
+    def _prune_apt_cache(self):
+        """Remove the least recently used .deb files of the apt cache, but
+        not the ones that concurrent builds may be installing.
+        """
+        if self.apt_cache_dir == '' or self.apt_cache_size <= 0:
+            return
+        # The archives of the sessions are hard links to the pool, or the
+        # leftovers of sessions that have not been cleaned up
+        sessions = os.path.join(self.apt_cache_dir, 'sessions')
+        try:
+            for entry in os.scandir(sessions):
+                if time.time() - entry.stat().st_mtime > APT_SESSION_MAX_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+        removed = evict_lru(
+            self.apt_cache_dir, self.apt_cache_size, '*.deb', APT_CACHE_MIN_AGE,
+            recursive=False
+        )
+        if removed:
+            m = "{}: Pruned {} MiB from the apt cache".format(
+                str(datetime.datetime.now()), removed // (1024 * 1024)
+            )
+            self.log(m)
 
     def _copy_sources(self):
         try:
@@ -513,61 +2256,188 @@ class CScoutKafkaPlugin(KafkaPlugin):
             )
             self.log(m)
 
+    def _read_events(self):
+        """Read the new complete events of the analyzer.
+
+        Returns:
+            The fields of every event, as in the lines of the report.
+        """
+        events = []
+        try:
+            with open(self.state.callgraph_dir + 'events.jsonl', 'rb') as f:
+                f.seek(self.state.events_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return events
+        # The last line may still be written
+        end = data.rfind(b'\n') + 1
+        self.state.events_offset += end
+        for line in data[:end].splitlines():
+            try:
+                fields = json.loads(line.decode('utf-8'))['fields']
+            except (ValueError, KeyError):
+                continue
+            if fields:
+                fields[0] = fields[0].lstrip()
+                fields[-1] = fields[-1].rstrip()
+                events.append(fields)
+        return events
+
+    def _tail_events(self, state, done):
+        """Produce the call graphs of the binary packages reported by the
+        analyzer while sbuild is running. Their messages are held until the
+        return code of sbuild is known.
+        """
+        self.state = state
+        while not done.wait(1):
+            for log in self._read_events():
+                if log[0] == 'time_elapsed' and len(log) >= 3:
+                    state.profiling_data['times'][log[1]] = log[2]
+                elif log[0] == 'produce_callgraph' and len(log) >= 3 and \
+                        log[2] == 'success':
+                    pkg = log[1]
+                    path = "{}/{}/".format(state.callgraph_dir, pkg)
+                    self.log("{}: Push call graph for {} to kafka topic".format(
+                        str(datetime.datetime.now()), pkg
+                    ))
+                    try:
+                        self._produce_cg_to_kafka(path, pkg, hold=True)
+                    except PluginError:
+                        # Reported again when checking the results
+                        continue
+                    state.pushed.add(pkg)
+        self.state = None
+
+    def _parse_time_files(self):
+        """Add the resources used by the steps of the analyzer, as measured
+        by /usr/bin/time, to the profiling data and the metrics.
+        """
+        resources = {}
+        for filename in glob.glob(self.state.callgraph_dir + '*.time'):
+            name = os.path.basename(filename)[:-len('.time')]
+            try:
+                usage = metrics.parse_time_file(filename)
+            except OSError:
+                continue
+            resources[name] = usage
+            step = 'build' if name == 'build' else 'analysis'
+            if 'max_rss_kb' in usage:
+                step_max_rss.observe(usage['max_rss_kb'] * 1024, step=step)
+            for mode in ('user', 'system'):
+                if mode in usage:
+                    step_cpu.inc(usage[mode], step=step, mode=mode)
+        if resources:
+            self.state.profiling_data['resources'] = resources
+
+    def _update_lag(self):
+        """Update the lag of the assigned partitions, at most every 30
+        seconds.
+        """
+        if self.consumer is None or time.time() - self.lag_checked < 30:
+            return
+        self.lag_checked = time.time()
+        try:
+            partitions = list(self.consumer.assignment())
+            end_offsets = self.consumer.end_offsets(partitions)
+            for p in partitions:
+                consumer_lag.set(
+                    end_offsets[p] - self.consumer.position(p),
+                    topic=p.topic, partition=p.partition
+                )
+        except Exception as e:
+            self.log("{}: Cannot get the consumer lag: {}".format(
+                str(datetime.datetime.now()), str(e)
+            ))
+
+    def _record_metrics(self, status):
+        packages_total.inc(status=status)
+        cache = self.state.profiling_data['cache']
+        cache_total.inc(cache['hits'], result='hit')
+        cache_total.inc(cache['misses'], result='miss')
+        connections = self.state.profiling_data.get('connections', {})
+        http_requests_total.inc(
+            connections.get('new_connections', 0), connection='new'
+        )
+        http_requests_total.inc(
+            connections.get('reused_connections', 0), connection='reused'
+        )
+        if self.metrics_textfile:
+            try:
+                registry.write_textfile(self.metrics_textfile)
+            except OSError as e:
+                self.log("{}: Cannot write metrics: {}".format(
+                    str(datetime.datetime.now()), str(e)
+                ))
+
     def _check_analysis_result(self):
         """Checks if call graph generated successfully.
+
+        The events of the analyzer are used if they exist, the report
+        otherwise.
         """
         try:
-            with open(self.state.callgraph_dir + 'report', 'r') as fd:
-                lines = [l.strip().split(': ') for l in fd
-                        if not l.startswith('#')]
-                for log in lines:
-                    if log[0] == 'time_elapsed':
-                        if len(log) >= 3:
-                            self.state.profiling_data['times'][log[1]] = log[2]
-                for log in lines:
-                    if log[0] == 'build':
-                        if log[1] == 'failed':
-                            self.state.error_msg['phase'] = 'build'
-                            self.state.error_msg['message'] = 'Build failed'
-                            self.state.error_msg['crashed'] = True
-                            raise PluginError('Build failed')
-                    elif log[0] == 'detect_binaries':
-                        if log[1] == 'failed':
-                            self.state.error_msg['phase'] = 'detect_binaries'
-                            self.state.error_msg['message'] = 'No binaries found'
-                            self.state.error_msg['crashed'] = True
-                            raise PluginError('No binaries found')
-                    elif log[0] == 'analysis':
-                        if log[2] == 'failed':
-                            self.state.error_msg['phase'] = 'analysis'
-                            self.state.error_msg['type'] = log[3]
-                            self.state.error_msg['message'] = log[1]
-                            self._produce_error_to_kafka()
-                    elif log[0] == 'produce_debs':
-                        if log[1] == 'failed':
-                            self.state.error_msg['phase'] = 'detect_binaries'
-                            self.state.error_msg['message'] = 'Produce debian packages failed'
-                            self.state.error_msg['crashed'] = True
-                            raise PluginError('Produce debian packages failed')
-                    elif log[0] == 'detect_packages':
-                        self.state.binary_pkgs = log[1].split(' ')
-                    elif log[0] == 'produce_callgraph':
-                        if log[2] == 'failed':
-                            self.state.error_msg['phase'] = 'produce_callgraph'
-                            self.state.error_msg['type'] = log[3]
-                            self.state.error_msg['message'] = log[1]
-                            self._produce_error_to_kafka()
-                        if log[2] == 'success':
-                            self.state.status = 'done'
-                            pkg = log[1]
-                            path = "{}/{}/".format(
-                                self.state.callgraph_dir, pkg
-                            )
-                            m = "{}: Push call graph for {} to kafka topic".format(
-                                str(datetime.datetime.now()), pkg
-                            )
-                            self.log(m)
-                            self._produce_cg_to_kafka(path, pkg)
+            self.state.events_offset = 0
+            lines = [l for l in self._read_events()
+                     if not l[0].startswith('#')]
+            if not lines:
+                with open(self.state.callgraph_dir + 'report', 'r') as fd:
+                    lines = [l.strip().split(': ') for l in fd
+                            if not l.startswith('#')]
+            for log in lines:
+                if log[0] == 'time_elapsed':
+                    if len(log) >= 3:
+                        self.state.profiling_data['times'][log[1]] = log[2]
+                        try:
+                            phase_seconds.observe(float(log[2]), phase=log[1])
+                        except ValueError:
+                            pass
+            self._parse_time_files()
+            for log in lines:
+                if log[0] == 'build':
+                    if log[1] == 'failed':
+                        self.state.error_msg['phase'] = 'build'
+                        self.state.error_msg['message'] = 'Build failed'
+                        self.state.error_msg['crashed'] = True
+                        raise PluginError('Build failed')
+                elif log[0] == 'detect_binaries':
+                    if log[1] == 'failed':
+                        self.state.error_msg['phase'] = 'detect_binaries'
+                        self.state.error_msg['message'] = 'No binaries found'
+                        self.state.error_msg['crashed'] = True
+                        raise PluginError('No binaries found')
+                elif log[0] == 'analysis':
+                    if log[2] == 'failed':
+                        self.state.error_msg['phase'] = 'analysis'
+                        self.state.error_msg['type'] = log[3]
+                        self.state.error_msg['message'] = log[1]
+                        self._produce_error_to_kafka()
+                elif log[0] == 'produce_debs':
+                    if log[1] == 'failed':
+                        self.state.error_msg['phase'] = 'detect_binaries'
+                        self.state.error_msg['message'] = 'Produce debian packages failed'
+                        self.state.error_msg['crashed'] = True
+                        raise PluginError('Produce debian packages failed')
+                elif log[0] == 'detect_packages':
+                    self.state.binary_pkgs = log[1].split(' ')
+                elif log[0] == 'produce_callgraph':
+                    if log[2] == 'failed':
+                        self.state.error_msg['phase'] = 'produce_callgraph'
+                        self.state.error_msg['type'] = log[3]
+                        self.state.error_msg['message'] = log[1]
+                        self._produce_error_to_kafka()
+                    if log[2] == 'success':
+                        self.state.status = 'done'
+                        pkg = log[1]
+                        if pkg in self.state.pushed:
+                            continue
+                        path = "{}/{}/".format(
+                            self.state.callgraph_dir, pkg
+                        )
+                        m = "{}: Push call graph for {} to kafka topic".format(
+                            str(datetime.datetime.now()), pkg
+                        )
+                        self.log(m)
+                        self._produce_cg_to_kafka(path, pkg)
         except FileNotFoundError:
             message = "File not found: " + self.state.callgraph_dir + "report"
             m = "{}: {}".format(
@@ -585,6 +2455,131 @@ class CScoutKafkaPlugin(KafkaPlugin):
             )
             self.log(m)
 
+    def _fingerprint(self):
+        """Return the fingerprint of the inputs of the analysis: the release,
+        the .dsc file, the analyzer, and the options of fcan.
+        """
+        dsc = glob.glob(os.path.join(self.state.dir_name, "*.dsc"))
+        if len(dsc) != 1:
+            return None
+        with open(dsc[0], 'rb') as f:
+            dsc_digest = hashlib.sha256(f.read()).hexdigest()
+        inputs = [
+            self.state.source, self.state.version, self.state.dist,
+            self.state.arch, dsc_digest, self.analyzer_digest,
+            os.environ.get('FCAN_EXTRA_OPTIONS', ''), self.cg_format
+        ]
+        return hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+    def _reuse_results(self):
+        """Emit the call graphs of a previous analysis with the same inputs.
+
+        Returns:
+            True if the results have been reused.
+        """
+        if self.manifest is None:
+            return False
+        if self.state.fingerprint is None or self.force_rebuild:
+            return False
+        entry = self.manifest.lookup(self.state.fingerprint)
+        if entry is None:
+            return False
+        m = "{}: Reuse the results of {} ({})".format(
+            str(datetime.datetime.now()), entry['created'],
+            self.state.fingerprint
+        )
+        self.log(m)
+        for payload in entry['payloads']:
+            message = self.create_message(
+                self.state.record, {"payload": payload}
+            )
+            self.emit_message(self.produce_topic, message, "succeed", "")
+        self.state.status = 'done'
+        return True
+
+    def _release_key(self):
+        """Return the key of a release, before its sources are downloaded.
+        """
+        release = [self.state.source, self.state.version, self.state.dist,
+                   self.state.arch]
+        return hashlib.sha256(json.dumps(release).encode('utf-8')).hexdigest()
+
+    def _skip_known_failure(self, key):
+        """Fail with the last error of a key, if it failed before and its
+        retry window has not ended.
+        """
+        if self.failures is None or key is None or self.force_rebuild:
+            return
+        entry = self.failures.blocked(key)
+        if entry is None:
+            return
+        retry_after = str(datetime.datetime.fromtimestamp(
+            entry['retry_after']
+        ))
+        message = "Known failure ({} failures), retry after {}".format(
+            entry['failures'], retry_after
+        )
+        self.log("{}: {}".format(str(datetime.datetime.now()), message))
+        self.state.skipped = True
+        self.state.error_msg['phase'] = entry['phase']
+        self.state.error_msg['message'] = entry['message']
+        self.state.error_msg['crashed'] = True
+        if entry['type']:
+            self.state.error_msg['type'] = entry['type']
+        self.state.error_msg['failures'] = entry['failures']
+        self.state.error_msg['retry_after'] = retry_after
+        raise PluginError(message)
+
+    def _record_failure(self):
+        """Record the error of a failed package. The errors of downloads are
+        recorded by release, the others by the fingerprint of the inputs.
+        """
+        if self.failures is None or self.state.skipped:
+            return
+        transient = self.state.error_msg['phase'] in TRANSIENT_PHASES
+        key = self.state.fingerprint
+        if transient or key is None:
+            key = self._release_key()
+        try:
+            entry = self.failures.record(key, self.state.error_msg, transient)
+        except OSError as e:
+            self.log("{}: Cannot record the failure: {}".format(
+                str(datetime.datetime.now()), str(e)
+            ))
+            return
+        self.log("{}: Failure {} of {}, retry after {}".format(
+            str(datetime.datetime.now()), entry['failures'],
+            self.state.dir_name,
+            str(datetime.datetime.fromtimestamp(entry['retry_after']))
+        ))
+
+    def _clear_failures(self):
+        if self.failures is None:
+            return
+        for key in (self._release_key(), self.state.fingerprint):
+            if key is not None:
+                self.failures.clear(key)
+
+    def _record_results(self):
+        """Add the call graphs of a successful analysis to the manifest.
+        """
+        if self.manifest is None or self.state.fingerprint is None or \
+                self.state.status != 'done' or not self.state.payloads:
+            return
+        try:
+            self.manifest.record(self.state.fingerprint, {
+                'source': self.state.source,
+                'version': self.state.version,
+                'dist': self.state.dist,
+                'arch': self.state.arch,
+                'created': str(datetime.datetime.now()),
+                'payloads': self.state.payloads
+            })
+        except OSError as e:
+            self.log("{}: Cannot update the manifest: {}".format(
+                str(datetime.datetime.now()), str(e)
+            ))
+
     def _cleanup(self):
         """Remove the downloaded sources and the call graphs from the
         filesystem.
@@ -622,19 +2617,39 @@ class CScoutKafkaPlugin(KafkaPlugin):
         message = self.create_message(self.state.record, self.state.err)
         self.emit_message(self.error_topic, message, "error", "")
 
-    def _produce_cg_to_kafka(self, path, pkg):
+    def _produce_cg_to_kafka(self, path, pkg, hold=False):
         """Push call graph to kafka topic and save it to disk.
+
+        The call graph is copied and sent as it is, only its header fields
+        are parsed. With hold the message is added to the held messages of
+        the package instead of being sent.
         """
+        fcg = path + 'fcg.json'
+        start = time.time()
         try:
-            with open(path + 'fcg.json', 'r') as f:
-                call_graph = json.load(f)
+            header = read_json_fields(
+                fcg, ('product', 'version', 'architecture')
+            )
             if self.directory != '':
+                # Other workers may save the same call graph, so it is staged
+                # in the working directory and renamed when complete
+                staging = self._staging_dir(pkg)
                 dst = os.path.join(self.directory, self.state.get_cg_dst(pkg))
                 os.makedirs(dst, exist_ok=True)
-                with open(os.path.join(dst, 'file.json'), 'w') as f:
-                    json.dump(call_graph, f)
+                if self.cg_format != 'compact':
+                    shutil.copyfile(fcg, os.path.join(staging, 'file.json'))
+                    publish_file(
+                        os.path.join(staging, 'file.json'),
+                        os.path.join(dst, 'file.json')
+                    )
+                if self.cg_format != 'json':
+                    compact_cg.convert(fcg, os.path.join(staging, 'file.fcg'))
+                    publish_file(
+                        os.path.join(staging, 'file.fcg'),
+                        os.path.join(dst, 'file.fcg')
+                    )
         except FileNotFoundError:
-            message = "File not found: " + path + "fcg.json"
+            message = "File not found: " + fcg
             m = "{}: {}".format(
                 str(datetime.datetime.now()),
                 message
@@ -651,49 +2666,117 @@ class CScoutKafkaPlugin(KafkaPlugin):
                 "Cannot copy {}".format(self.state.get_cg_dst(pkg))
             )
             self.log(m)
-        call_graph['profiling_data'] = self.state.profiling_data
         dst = os.path.join(self.directory, self.state.dst)
-        call_graph['sourcePath'] = dst
         if self.directory != '':
             cg_dst = os.path.join(self.directory, self.state.get_cg_dst(pkg))
-            cg_dst = os.path.join(cg_dst, "file.json")
+            cg_dst = os.path.join(
+                cg_dst,
+                "file.fcg" if self.cg_format == 'compact' else "file.json"
+            )
             sources_dst = os.path.join(self.directory, self.state.get_sources_dst())
+            payload = {
+                "dir": cg_dst,
+                "forge": self.state.forge,
+                "product": header['product'],
+                "version": header['version'],
+                "arch": header['architecture'],
+                "dist": self.state.dist,
+                "sourcePath": sources_dst
+            }
+            self.state.payloads.append(payload)
+            message = self.create_message(
+                self.state.record, {"payload": payload}
+            )
+        elif self.spill_directory and \
+                os.path.getsize(fcg) > self.inline_max_bytes:
+            # Too large to be sent inline, send where to find it
+            cg_dst = os.path.join(
+                self.spill_directory, self.state.get_cg_dst(pkg)
+            )
+            os.makedirs(cg_dst, exist_ok=True)
+            cg_dst = os.path.join(cg_dst, "file.json")
+            staged = os.path.join(self._staging_dir(pkg), "file.json")
+            shutil.copyfile(fcg, staged)
+            publish_file(staged, cg_dst)
             message = self.create_message(
                 self.state.record,
                 {"payload": {
                     "dir": cg_dst,
                     "forge": self.state.forge,
-                    "product": call_graph['product'],
-                    "version": call_graph['version'],
-                    "arch": call_graph['architecture'],
+                    "product": header['product'],
+                    "version": header['version'],
+                    "arch": header['architecture'],
                     "dist": self.state.dist,
-                    "sourcePath": sources_dst
+                    "sourcePath": dst,
+                    "profiling_data": self.state.profiling_data
                 }}
             )
         else:
-            message = self.create_message(self.state.record, {"payload": call_graph})
-        self.emit_message(self.produce_topic, message, "succeed", "")
+            message = splice_payload(
+                self.create_message(self.state.record, {}), fcg,
+                {"profiling_data": self.state.profiling_data,
+                 "sourcePath": dst}
+            )
+        if hold:
+            self.state.held.append((self.produce_topic, message))
+        else:
+            self.emit_message(self.produce_topic, message, "succeed", "")
+        phase_seconds.observe(time.time() - start, phase='produce_callgraph')
 
-    def consume(self, record):
+    def _staging_dir(self, pkg):
+        """Return the directory where the outputs of a binary package are
+        written before being renamed to their destination.
+        """
+        return create_dir(os.path.join(self.state.dir_name, '.staging', pkg))
+
+    def consume(self, record, state=None):
         """First download the sources, then run sbuild, and finally check the
            results.
+
+        Args:
+            record
+            state: the PackageState of the record if its sources have been
+                prefetched
         """
         # State of package
-        self.state = PackageState(record)
+        if state is None:
+            self.state = PackageState(record, self.work_dir())
+        else:
+            self.state = state
+        if threading.current_thread() is threading.main_thread():
+            self._update_lag()
         # Begin
         message = self.create_message(self.state.record, {"status": "begin"})
         self.emit_message(self.log_topic, message, "begin", "")
+        status = 'success'
         try:
-            self.download()
-            self._run_sbuild()
-            self._check_analysis_result()
+            if state is None:
+                self._skip_known_failure(self._release_key())
+                self.download()
+            elif state.prefetch_error is not None:
+                raise state.prefetch_error
+            self.state.fingerprint = self._fingerprint()
+            if self._reuse_results():
+                status = 'reused'
+            else:
+                self._skip_known_failure(self.state.fingerprint)
+                self._run_sbuild()
+                self._check_analysis_result()
+                self._record_results()
+            self._clear_failures()
             message = self.create_message(self.state.record, {"status": "success"})
             self.emit_message(self.log_topic, message, "complete", "")
         except PluginError:
+            status = 'skipped' if self.state.skipped else 'failed'
+            self._record_failure()
             self._produce_error_to_kafka()
             message = self.create_message(self.state.record, {"status": "failed"})
             self.emit_message(self.log_topic, message, "failed", "")
-        os.chdir(self.state.old_cwd)
+        self._record_metrics(status)
+        if self.produced:
+            self.log("{}: Produced: {}".format(
+                str(datetime.datetime.now()), self.produced_metrics()
+            ))
         self.flush_logs()
         self._cleanup()
         # End
@@ -705,11 +2788,27 @@ class CScoutKafkaPlugin(KafkaPlugin):
                 str(datetime.datetime.now()), phase, log_msg, topic
             ))
             filename = "/home/builder/debug/" + topic + ".json"
-            json.dump(msg, open(filename, 'a'))
             with open(filename, 'a') as f:
+                if isinstance(msg, RawMessage):
+                    f.write(msg)
+                else:
+                    json.dump(msg, f)
                 f.write("\n")
         else:
-            super().emit_message(topic, msg, phase, log_msg)
+            self.log("{}: Phase: {} Sent: {} to {}".format(
+                str(datetime.datetime.now()), phase, log_msg, topic
+            ))
+            if not isinstance(msg, RawMessage):
+                msg = json.dumps(msg)
+            self.producer.send(topic, msg)
+            with stats_lock:
+                produced = self.produced.setdefault(
+                    topic, {'messages': 0, 'bytes': 0}
+                )
+                produced['messages'] += 1
+                produced['bytes'] += len(msg)
+            produced_messages_total.inc(topic=topic)
+            produced_bytes_total.inc(len(msg), topic=topic)
 
 
 def get_parser():
@@ -772,6 +2871,160 @@ def get_parser():
         type=str,
         help="Debug mode, you should provide a JSON with a release."
     )
+    parser.add_argument(
+        '-c',
+        '--cache-dir',
+        type=str,
+        default='',
+        help="Path to directory where downloaded sources will be cached."
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=10240,
+        help="Maximum size of the sources cache (in MiB)."
+    )
+    parser.add_argument(
+        '--fetch-jobs',
+        type=int,
+        default=4,
+        help="Number of source files to download in parallel."
+    )
+    parser.add_argument(
+        '--host-connections',
+        type=int,
+        default=2,
+        help="Maximum number of parallel connections per host."
+    )
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=10,
+        help="Number of connections to keep alive in the connection pools."
+    )
+    parser.add_argument(
+        '--snapshot-mirror',
+        type=str,
+        default='',
+        help="Use this mirror instead of https://snapshot.debian.org."
+    )
+    parser.add_argument(
+        '--debian-mirror',
+        type=str,
+        default='',
+        help="Use this mirror instead of http://deb.debian.org/debian."
+    )
+    parser.add_argument(
+        '--sources-index',
+        type=str,
+        default='',
+        help="Path to directory where the index of the archive is saved."
+    )
+    parser.add_argument(
+        '--index-ttl',
+        type=int,
+        default=6 * 60 * 60,
+        help="Time after which the index of a dist is refreshed (in sec)."
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of packages to build concurrently."
+    )
+    parser.add_argument(
+        '--worker-memory',
+        type=int,
+        default=0,
+        help=("Memory budget of each worker (in MiB), used to limit the "
+              "number of workers to the memory of the container.")
+    )
+    parser.add_argument(
+        '-p',
+        '--prefetch',
+        type=int,
+        default=0,
+        help="Number of records to download ahead while building."
+    )
+    parser.add_argument(
+        '--prefetch-disk',
+        type=int,
+        default=10240,
+        help="Maximum size of the prefetched sources (in MiB)."
+    )
+    parser.add_argument(
+        '--cg-format',
+        choices=['json', 'compact', 'both'],
+        default='json',
+        help="Format of the call graphs saved in directory."
+    )
+    parser.add_argument(
+        '--compression',
+        choices=['none', 'gzip', 'snappy', 'lz4', 'zstd'],
+        default='none',
+        help="Compression of the produced messages."
+    )
+    parser.add_argument(
+        '--inline-max-bytes',
+        type=int,
+        default=900000,
+        help="Maximum size of a call graph sent in a message, larger ones "
+             "are saved in the spill directory."
+    )
+    parser.add_argument(
+        '--spill-directory',
+        type=str,
+        default='',
+        help="Path to directory where large call graphs are saved when "
+             "--directory is not used."
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=0,
+        help="Port to serve Prometheus metrics on /metrics (0 to disable)."
+    )
+    parser.add_argument(
+        '--metrics-textfile',
+        type=str,
+        default='',
+        help="File to write Prometheus metrics to after every package."
+    )
+    parser.add_argument(
+        '--apt-cache-dir',
+        type=str,
+        default='',
+        help="Directory of the apt archives shared by the chroots "
+             "(e.g. /var/cache/sbuild/apt), pruned after every build."
+    )
+    parser.add_argument(
+        '--apt-cache-size',
+        type=int,
+        default=20480,
+        help="Maximum size of the apt archives (in MiB)."
+    )
+    parser.add_argument(
+        '--force-rebuild',
+        action='store_true',
+        help="Analyze the releases again even if their results exist in the "
+             "manifest of the directory, or if they failed recently."
+    )
+    parser.add_argument(
+        '--analyzer-digest',
+        type=str,
+        default=os.environ.get('ANALYZER_DIGEST', ''),
+        help="Digest of the analyzer (e.g. of its image), part of the "
+             "fingerprint of the results (default: $ANALYZER_DIGEST, or a "
+             "digest of the analyzer scripts)."
+    )
+    parser.add_argument(
+        '--failures-dir',
+        type=str,
+        default='',
+        help="Path to directory where failures are recorded, to skip the "
+             "releases that failed until their retry window ends."
+    )
     return parser
 
 
@@ -788,6 +3041,10 @@ def main():
     sleep_time = args.sleep_time
     directory = args.directory
     debug = args.debug
+    cache_dir = args.cache_dir
+    cache_size = args.cache_size
+    configure_fetching(args.fetch_jobs, args.host_connections, args.pool_size)
+    configure_mirrors(args.snapshot_mirror, args.debian_mirror)
     mandatory_args = (
         in_topic, out_topic, err_topic, log_topic, bootstrap_servers, group
     )
@@ -802,7 +3059,13 @@ def main():
 
     plugin = CScoutKafkaPlugin(
         bootstrap_servers, in_topic, out_topic,
-        log_topic, err_topic, group, directory, debug
+        log_topic, err_topic, group, directory, debug, cache_dir, cache_size,
+        args.sources_index, args.index_ttl, args.workers, args.worker_memory,
+        args.prefetch, args.prefetch_disk, args.cg_format,
+        None if args.compression == 'none' else args.compression,
+        args.inline_max_bytes, args.spill_directory, args.metrics_port,
+        args.metrics_textfile, args.apt_cache_dir, args.apt_cache_size,
+        args.force_rebuild, args.analyzer_digest, args.failures_dir
     )
 
     if debug:
@@ -0,0 +1,236 @@
+# Copyright (c) 2018-2020 FASTEN.
+#
+# This file is part of FASTEN
+# (see https://www.fasten-project.eu/).
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Metrics in the Prometheus text format, served on /metrics or written to
+a file for the textfile collector of the node exporter.
+"""
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Buckets of durations (in seconds), from one second to a day
+TIME_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200,
+                14400, 28800, 86400)
+# Buckets of memory sizes (in bytes), from 16MiB to 64GiB
+MEMORY_BUCKETS = tuple(2 ** i for i in range(24, 37))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, _escape(v)) for k, v in pairs
+    ) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(k, '')) for k in self.labels)
+
+    def header(self):
+        return "# HELP {} {}\n# TYPE {} {}\n".format(
+            self.name, self.documentation, self.name, self.type
+        )
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            return ''.join(
+                '{}{} {}\n'.format(self.name, _labels(self.labels, k),
+                                   _number(v))
+                for k, v in sorted(self.values.items())
+            )
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(
+                key, ([0] * len(self.buckets), 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}\n'.format(
+                        self.name,
+                        _labels(self.labels, key, [('le', _number(bound))]),
+                        count
+                    ))
+                lines.append('{}_sum{} {}\n'.format(
+                    self.name, _labels(self.labels, key), _number(total)
+                ))
+                lines.append('{}_count{} {}\n'.format(
+                    self.name, _labels(self.labels, key), counts[-1]
+                ))
+        return ''.join(lines)
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        return ''.join(m.header() + m.render() for m in self.metrics)
+
+    def write_textfile(self, filename):
+        """Write the metrics atomically, for the textfile collector.
+        """
+        text = self.render()
+        with self.lock:
+            with open(filename + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(filename + '.tmp', filename)
+
+    def serve(self, port, address=''):
+        """Serve the metrics on http://address:port/metrics in a daemon
+        thread.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8'
+                )
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+TIME_FIELDS = {
+    'User time (seconds)': 'user',
+    'System time (seconds)': 'system',
+    'Maximum resident set size (kbytes)': 'max_rss_kb',
+    'Elapsed (wall clock) time (h:mm:ss or m:ss)': 'elapsed',
+    'Exit status': 'exit_status',
+}
+
+
+def parse_time_file(filename):
+    """Parse the output of /usr/bin/time -v.
+
+    Returns:
+        A dict with user, system, elapsed (in seconds), max_rss_kb, and
+        exit_status, for the fields that have been found.
+    """
+    result = {}
+    with open(filename, 'r', errors='replace') as f:
+        for line in f:
+            key, sep, value = line.strip().rpartition(': ')
+            if not sep or key not in TIME_FIELDS:
+                continue
+            field = TIME_FIELDS[key]
+            try:
+                if field == 'elapsed':
+                    seconds = 0.0
+                    for part in value.split(':'):
+                        seconds = seconds * 60 + float(part)
+                    result[field] = seconds
+                elif field in ('max_rss_kb', 'exit_status'):
+                    result[field] = int(value)
+                else:
+                    result[field] = float(value)
+            except ValueError:
+                continue
+    return result
+
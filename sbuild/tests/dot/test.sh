@@ -0,0 +1,40 @@
+#! /bin/bash
+# Check the edges that the stream readers of dot2csv and dot2fasten read from
+# the DOT files, and that -e networkx reads the same edges when networkx and
+# pydot are installed (it ignores the edges of subgraphs).
+
+GRAPHS="statements subgraph"
+DOT2CSV=../../scripts/dynamic/dot2csv
+DOT2FASTEN=../../../dynamic/dot2fasten
+
+cd "$(dirname "$0")"
+TEMP=$(mktemp -d)
+trap "rm -rf $TEMP" EXIT
+STATUS=0
+
+check() {
+    if diff "$2" "results/$1.csv"; then
+        echo "Success: $1 ($3)"
+    else
+        echo "#############FAILED: $1 ($3)#############"
+        STATUS=1
+    fi
+}
+
+for g in $GRAPHS; do
+    python3 $DOT2CSV $g.dot $TEMP/$g.csv
+    check $g $TEMP/$g.csv dot2csv
+    python3 - $DOT2FASTEN $g.dot > $TEMP/$g.fasten.csv << 'PYTHON'
+import csv
+import sys
+from importlib.machinery import SourceFileLoader
+dot2fasten = SourceFileLoader('dot2fasten', sys.argv[1]).load_module()
+csv.writer(sys.stdout).writerows(dot2fasten.read_edges_stream(sys.argv[2]))
+PYTHON
+    check $g $TEMP/$g.fasten.csv dot2fasten
+done
+if python3 -c "import networkx, pydot" 2> /dev/null; then
+    python3 $DOT2CSV -e networkx statements.dot $TEMP/statements.networkx.csv
+    check statements $TEMP/statements.networkx.csv networkx
+fi
+exit $STATUS
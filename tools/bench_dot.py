@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Benchmark the engines of dot2csv (stream and networkx) on a DOT file, or
+on a generated gprof2dot-like graph.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess as sp
+
+
+DOT2CSV = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..', 'sbuild', 'scripts', 'dynamic', 'dot2csv'
+)
+
+
+def generate_dot(path, nodes, edges, seed=0):
+    """Write a graph in the format of gprof2dot -f prof (the nodes are
+    numbers and the function names are in the labels).
+    """
+    rand = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('digraph {\n\ttooltip=" "\n')
+        f.write('\tgraph [fontname=Arial, nodesep=0.125, ranksep=0.25];\n')
+        f.write('\tnode [fontcolor=white, fontname=Arial, height=0, '
+                'shape=box, style=filled, width=0];\n')
+        f.write('\tedge [fontname=Arial];\n')
+        for i in range(nodes):
+            f.write(
+                '\t{} [color="#0d0d73", fontcolor="#ffffff", '
+                'fontsize="10.00", label="function_{}\\n0.01%\\n(0.01%)'
+                '\\n1\xd7"];\n'.format(i, i)
+            )
+        for _ in range(edges):
+            f.write(
+                '\t{} -> {} [arrowsize="0.35", color="#0d0d73", '
+                'fontcolor="#0d0d73", fontsize="10.00", '
+                'label="0.01%\\n1\xd7", labeldistance="0.50", '
+                'penwidth="0.50"];\n'.format(
+                    rand.randrange(nodes), rand.randrange(nodes)
+                )
+            )
+        f.write('}\n')
+
+
+def run(dot2csv, engine, input_dot, output_csv, profile):
+    """Run dot2csv and return its wall time (s) and maximum RSS (KiB).
+    """
+    cmd = [sys.executable, dot2csv, '-e', engine, input_dot, output_csv]
+    if profile:
+        cmd.append('-p')
+    start = time.time()
+    proc = sp.Popen(cmd)
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError("{} failed".format(' '.join(cmd)))
+    return elapsed, usage.ru_maxrss
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        "Benchmark the engines of dot2csv."
+    )
+    parser.add_argument(
+        'input_dot', nargs='?',
+        help="DOT file (default: generate a graph)"
+    )
+    parser.add_argument('-n', '--nodes', type=int, default=10000,
+                        help="Nodes of the generated graph.")
+    parser.add_argument('-e', '--edges', type=int, default=200000,
+                        help="Edges of the generated graph.")
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help="Use the labels of the nodes (gprof).")
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help="Runs per engine.")
+    parser.add_argument('--engines', nargs='+',
+                        default=['stream', 'networkx'],
+                        help="Engines to benchmark.")
+    parser.add_argument('--dot2csv', default=DOT2CSV,
+                        help="Path of dot2csv.")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dot = args.input_dot
+        if input_dot is None:
+            input_dot = os.path.join(tmp, 'graph.dot')
+            generate_dot(input_dot, args.nodes, args.edges)
+        print("{}: {:.1f} MiB".format(
+            input_dot, os.path.getsize(input_dot) / 2 ** 20
+        ))
+        outputs = {}
+        for engine in args.engines:
+            output_csv = os.path.join(tmp, engine + '.csv')
+            for _ in range(args.repeat):
+                elapsed, rss = run(
+                    args.dot2csv, engine, input_dot, output_csv, args.profile
+                )
+                print("{:10} {:8.2f} s {:8.1f} MiB".format(
+                    engine, elapsed, rss / 1024
+                ))
+            with open(output_csv, 'r') as f:
+                outputs[engine] = sorted(f)
+        # The engines write the same edges, in a different order
+        if len(set(map(tuple, outputs.values()))) > 1:
+            print("Warning: the engines produced different edges")
+
+
+if __name__ == "__main__":
+    main()